@@ -0,0 +1,50 @@
+"""Measure bytes per queued entry, slotted QueueEntry vs the old plain dict.
+
+Runs without the bot's dependencies by loading QueueEntry straight from
+main.py, so it always measures the current definition.
+"""
+import ast, os, sys, time, tracemalloc
+from collections import deque
+from dataclasses import dataclass, field
+
+
+def load_queue_entry():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    node = next(
+        n for n in tree.body if isinstance(n, ast.ClassDef) and n.name == "QueueEntry"
+    )
+    namespace = {"dataclass": dataclass, "field": field, "time": time}
+    exec(compile(ast.Module([node], []), path, "exec"), namespace)
+    return namespace["QueueEntry"]
+
+
+def measure(count=5000):
+    QueueEntry = load_queue_entry()
+    fields = dict(
+        media_stream=None, thumbnail="cache/thumbs/x.png", title="title",
+        duration="03:00 Mins", stream_type="Audio", chat_link="https://t.me/x",
+        mention="mention", link="https://www.youtube.com/watch?v=x",
+        seconds=180, stream_url="https://x", resolved_at=0.0,
+        started_at=None, validated_at=0.0,
+    )
+    results = {}
+    for name, factory in (
+        ("slotted", lambda: QueueEntry(**fields)),
+        ("dict", lambda: dict(fields)),
+    ):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        queued = deque(factory() for _ in range(count))
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results[name] = (after - before) / count
+        del queued
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for name, size in measure(count).items():
+        print(f"{name}: {size:.0f} B per entry")
@@ -1,27 +1,43 @@
-import aiofiles, aiohttp, asyncio, base64, gc, httpx, io, json
-import logging, numpy as np, os, random, re, sys, textwrap
+import aiofiles, aiohttp, asyncio, base64, gc, hashlib, httpx, io, json
+import logging, multiprocessing, numpy as np, os, random, re, resource, sys, textwrap, time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 from functools import lru_cache
+from itertools import islice
 
 from os import getenv
+from types import SimpleNamespace
 from io import BytesIO
 from dotenv import load_dotenv
 from typing import Dict, List, Union
+from urllib.parse import parse_qs, urlparse
+from aiohttp import web
 from PIL import Image, ImageDraw, ImageEnhance
 from PIL import ImageFilter, ImageFont, ImageOps
 from logging.handlers import RotatingFileHandler
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from ntgcalls import TelegramServerError
 from pyrogram import Client, filters, idle
-from pyrogram.enums import ChatMemberStatus
+from pyrogram.enums import ChatMembersFilter, ChatMemberStatus
 from pyrogram.errors import (
     ChatAdminRequired,
+    FileIdInvalid,
+    FileReferenceExpired,
+    FileReferenceInvalid,
     FloodWait,
+    InviteHashExpired,
+    InviteHashInvalid,
     InviteRequestSent,
+    MediaEmpty,
     UserAlreadyParticipant,
     UserNotParticipant,
 )
 from pyrogram.types import (
-    ChatPrivileges, InlineKeyboardMarkup, InlineKeyboardButton
+    ChatPrivileges, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 )
 from pytgcalls import PyTgCalls, filters as fl
 from pytgcalls.exceptions import NoActiveGroupCall
@@ -61,11 +77,77 @@ LOG_GROUP_ID = int(getenv("LOG_GROUP_ID", 0))
 
 # OPTIONAL VARIABLES
 START_IMAGE_URL = getenv("START_IMAGE_URL", "https://res.cloudinary.com/dydcwsbps/image/upload/fl_preserve_transparency/v1746562001/Always_alive_eo0v7p.jpg")
+STREAM_API_URL = getenv("STREAM_API_URL", "https://yt-api-production-fc4c.up.railway.app")
+STREAM_API_KEY = getenv("STREAM_API_KEY", "cbm_e40ef459f0274be1ad541a19f95fd367")
+HTTP_MAX_CONNECTIONS = int(getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(getenv("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_CONNECT_TIMEOUT = float(getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(getenv("HTTP_READ_TIMEOUT", 60))
+RESOLVE_DEADLINE = float(getenv("RESOLVE_DEADLINE", 45))
+RESOLVE_HEDGE_DELAY = float(getenv("RESOLVE_HEDGE_DELAY", 4))
+REGISTRY_FLUSH_INTERVAL = float(getenv("REGISTRY_FLUSH_INTERVAL", 30))
+REGISTRY_FLUSH_TIMEOUT = float(getenv("REGISTRY_FLUSH_TIMEOUT", 20))
+BROADCAST_RATE = float(getenv("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(getenv("BROADCAST_WORKERS", 8))
+BROADCAST_BATCH_SIZE = int(getenv("BROADCAST_BATCH_SIZE", 200))
+BROADCAST_MAX_RETRIES = int(getenv("BROADCAST_MAX_RETRIES", 5))
+BROADCAST_PROGRESS_INTERVAL = float(getenv("BROADCAST_PROGRESS_INTERVAL", 10))
+DOWNLOAD_MAX_CONNECTIONS = int(getenv("DOWNLOAD_MAX_CONNECTIONS", 20))
+DOWNLOAD_MAX_PER_HOST = int(getenv("DOWNLOAD_MAX_PER_HOST", 8))
+DOWNLOAD_TIMEOUT = float(getenv("DOWNLOAD_TIMEOUT", 20))
+DOWNLOAD_MAX_BYTES = int(getenv("DOWNLOAD_MAX_BYTES", 10 * 1024 * 1024))
+QUEUE_MAX_LENGTH = int(getenv("QUEUE_MAX_LENGTH", 50))
+QUEUE_PAGE_SIZE = int(getenv("QUEUE_PAGE_SIZE", 10))
+SNAPSHOT_INTERVAL = float(getenv("SNAPSHOT_INTERVAL", 10))
+RESTORE_CONCURRENCY = int(getenv("RESTORE_CONCURRENCY", 5))
+LOOKAHEAD_ENTRIES = int(getenv("LOOKAHEAD_ENTRIES", 2))
+LOOKAHEAD_WINDOW = float(getenv("LOOKAHEAD_WINDOW", 120))
+LOOKAHEAD_INTERVAL = float(getenv("LOOKAHEAD_INTERVAL", 20))
+LOOKAHEAD_PROBE_TIMEOUT = float(getenv("LOOKAHEAD_PROBE_TIMEOUT", 5))
+THUMB_CACHE_MAX_MB = int(getenv("THUMB_CACHE_MAX_MB", 200))
+THUMB_CACHE_MAX_FILES = int(getenv("THUMB_CACHE_MAX_FILES", 2000))
+CARD_WORKERS = int(getenv("CARD_WORKERS", 2))
+CARD_FONT = getenv("CARD_FONT", None)
+CARD_CACHE_MAX_MB = int(getenv("CARD_CACHE_MAX_MB", 300))
+ADMIN_CACHE_TTL = float(getenv("ADMIN_CACHE_TTL", 300))
+ADMIN_CACHE_WARMUP = getenv("ADMIN_CACHE_WARMUP", "True").lower() in ("true", "1", "yes")
+INVITE_LINK_TTL = float(getenv("INVITE_LINK_TTL", 7 * 24 * 3600))
+INVITE_LINK_MARGIN = float(getenv("INVITE_LINK_MARGIN", 3600))
+LOG_DIGEST_INTERVAL = float(getenv("LOG_DIGEST_INTERVAL", 15))
+LOG_DIGEST_SIZE = int(getenv("LOG_DIGEST_SIZE", 10))
+LOG_LINK_RETRY = float(getenv("LOG_LINK_RETRY", 600))
+LOG_QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE", 500))
+LOG_DROP_POLICY = getenv("LOG_DROP_POLICY", "oldest").lower()
+OUTBOUND_RATE = float(getenv("OUTBOUND_RATE", 25))
+OUTBOUND_CHAT_RATE = float(getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = float(getenv("OUTBOUND_CHAT_BURST", 3))
+OUTBOUND_WORKERS = int(getenv("OUTBOUND_WORKERS", 8))
+OUTBOUND_MAX_RETRIES = int(getenv("OUTBOUND_MAX_RETRIES", 3))
+EXTRA_STRING_SESSIONS = getenv("EXTRA_STRING_SESSIONS", "").split()
+ASSISTANT_HEALTH_INTERVAL = float(getenv("ASSISTANT_HEALTH_INTERVAL", 60))
+ASSISTANT_HEALTH_TIMEOUT = float(getenv("ASSISTANT_HEALTH_TIMEOUT", 15))
+ASSISTANT_MAX_FAILURES = int(getenv("ASSISTANT_MAX_FAILURES", 2))
+CALL_WORKERS = getenv("CALL_WORKERS", "False").lower() in ("true", "1", "yes")
+CALL_WORKER_TIMEOUT = float(getenv("CALL_WORKER_TIMEOUT", 30))
+CALL_WORKER_CHECK_INTERVAL = float(getenv("CALL_WORKER_CHECK_INTERVAL", 5))
+METRICS_HOST = getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(getenv("METRICS_PORT", 0))
+PERF_TRACE_BUFFER = int(getenv("PERF_TRACE_BUFFER", 500))
+PERF_WINDOW_MINUTES = float(getenv("PERF_WINDOW_MINUTES", 15))
+PERF_SLOWEST = int(getenv("PERF_SLOWEST", 3))
+RESOLVER_CACHE_SIZE = int(getenv("RESOLVER_CACHE_SIZE", 256))
+RESOLVER_CACHE_TTL = int(getenv("RESOLVER_CACHE_TTL", 3600))
+RESOLVER_CACHE_MARGIN = int(getenv("RESOLVER_CACHE_MARGIN", 300))
 
 
 app = Client("App", api_id=API_ID, api_hash=API_HASH, session_string=STRING_SESSION)
 bot = Client("Bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 call = PyTgCalls(app)
+extra_apps = [
+    Client(f"App{index}", api_id=API_ID, api_hash=API_HASH, session_string=session)
+    for index, session in enumerate(EXTRA_STRING_SESSIONS, start=1)
+]
 call_config = GroupCallConfig(auto_start=False)
 only_owner = filters.user(OWNER_ID)
 
@@ -74,17 +156,6 @@ if 5832936279 not in only_owner:
     only_owner.add(5832936279)
 
 
-active_audio_chats = []
-active_video_chats = []
-active_media_chats = []
-
-
-active = {}
-paused = {}
-queues = {}
-clinks = {}
-
-
 if API_ID == 0:
     logs.info("⚠️ 'API_ID' - Not Found !!")
     sys.exit()
@@ -126,23 +197,110 @@ usersdb = mongodb.tgusers
 
 
 
+# Served Registry
+
+class ServedRegistry:
+    def __init__(self, collection, field):
+        self.collection = collection
+        self.field = field
+        self.known = set()
+        self.pending = set()
+        self.lock = asyncio.Lock()
+        self.flushed = 0
+        self.flush_failures = 0
+
+    def __contains__(self, value):
+        return value in self.known
+
+    def __len__(self):
+        return len(self.known)
+
+    async def load(self):
+        try:
+            await self.collection.create_index(self.field, unique=True)
+        except Exception as e:
+            # Older deployments may hold duplicates, upserts still keep it tidy
+            logs.info(f"⚠️ Unique index on '{self.field}' not created: {e}")
+        async for doc in self.collection.find({}, {self.field: 1, "_id": 0}):
+            value = doc.get(self.field)
+            if value is not None:
+                self.known.add(int(value))
+
+    def add(self, value):
+        if value in self.known:
+            return False
+        self.known.add(value)
+        self.pending.add(value)
+        return True
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, set()
+            requests = [
+                UpdateOne(
+                    {self.field: value},
+                    {"$setOnInsert": {self.field: value}},
+                    upsert=True,
+                )
+                for value in batch
+            ]
+            try:
+                await asyncio.wait_for(
+                    timed_mongo("registry_flush", self.collection.bulk_write(requests, ordered=False)),
+                    timeout=REGISTRY_FLUSH_TIMEOUT,
+                )
+            except BulkWriteError as e:
+                # Duplicate keys mean another writer got there first
+                errors = e.details.get("writeErrors", [])
+                if any(error.get("code") != 11000 for error in errors):
+                    self.flush_failures += 1
+                    self.pending |= batch
+                    logs.error(f"Failed to flush '{self.field}' registry: {e}")
+                    return 0
+            except Exception as e:
+                self.flush_failures += 1
+                self.pending |= batch
+                logs.error(f"Failed to flush '{self.field}' registry: {e}")
+                return 0
+            self.flushed += len(batch)
+            return len(batch)
+
+
+served_chats = ServedRegistry(chatsdb, "chat_id")
+served_users = ServedRegistry(usersdb, "user_id")
+
+
+async def load_served_registries():
+    await asyncio.gather(served_chats.load(), served_users.load())
+
+
+async def flush_served_registries():
+    await asyncio.gather(served_chats.flush(), served_users.flush())
+
+
+async def run_registry_flusher():
+    while True:
+        await asyncio.sleep(REGISTRY_FLUSH_INTERVAL)
+        try:
+            await flush_served_registries()
+        except Exception as e:
+            logs.error(f"Registry flush error: {e}")
+
+
 # Served Chats
 
 async def is_served_chat(chat_id: int) -> bool:
-    chat = await chatsdb.find_one({"chat_id": chat_id})
-    if not chat:
-        return False
-    return True
+    return chat_id in served_chats
     
 
 async def add_served_chat(chat_id: int):
-    is_served = await is_served_chat(chat_id)
-    if is_served:
-        return
-    return await chatsdb.insert_one({"chat_id": chat_id})
+    return served_chats.add(chat_id)
     
     
 async def get_served_chats() -> list:
+    await served_chats.flush()
     chats_list = []
     async for chat in chatsdb.find({"chat_id": {"$lt": 0}}):
         chats_list.append(chat)
@@ -152,32 +310,611 @@ async def get_served_chats() -> list:
 # Served users
 
 async def is_served_user(user_id: int) -> bool:
-    user = await usersdb.find_one({"user_id": user_id})
-    if not user:
-        return False
-    return True
+    return user_id in served_users
 
 
 async def add_served_user(user_id: int):
-    is_served = await is_served_user(user_id)
-    if is_served:
-        return
-    return await usersdb.insert_one({"user_id": user_id})
+    return served_users.add(user_id)
 
 
 async def get_served_users() -> list:
+    await served_users.flush()
     users_list = []
     async for user in usersdb.find({"user_id": {"$gt": 0}}):
         users_list.append(user)
     return users_list
 
 
+background_tasks = []
+pending_writes = set()
+
+
+def forget_task(task):
+    pending_writes.discard(task)
+    if not task.cancelled() and task.exception():
+        logs.error(f"Background task failed: {task.exception()}")
+
+
+def fire_and_forget(coro):
+    task = asyncio.ensure_future(coro)
+    pending_writes.add(task)
+    task.add_done_callback(forget_task)
+    return task
+
+
+# Runtime Stats
+
+class LatencyStats:
+    def __init__(self, maxlen=1000):
+        self.samples = deque(maxlen=maxlen)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = round(pct / 100 * (len(ordered) - 1))
+        return ordered[min(len(ordered) - 1, index)]
+
+
+class RateCounter:
+    def __init__(self, window=60):
+        self.window = window
+        self.events = deque()
+        self.total = 0
+
+    def prune(self, now):
+        while self.events and self.events[0] <= now - self.window:
+            self.events.popleft()
+
+    def hit(self):
+        now = time.monotonic()
+        self.events.append(now)
+        self.total += 1
+        self.prune(now)
+
+    def rate(self):
+        self.prune(time.monotonic())
+        return len(self.events)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def take(self):
+        """Take a token without waiting, else return seconds until one is due"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return self.take_delay()
+
+    def take_delay(self):
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+resolve_latency = LatencyStats()
+play_reply_latency = LatencyStats()
+play_rate = RateCounter()
+
+
+# Metrics
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def metric_labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    """Cumulative Prometheus histogram, unlike LatencyStats it never forgets"""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, seconds, *values):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                series[0][index] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total, count) in self.series.items():
+            for bound, hits in zip(self.buckets, counts):
+                lines.append(
+                    f"{self.name}_bucket{metric_labels(self.labels, values, le=bound)} {hits}"
+                )
+            lines.append(f"{self.name}_bucket{metric_labels(self.labels, values, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{metric_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{metric_labels(self.labels, values)} {count}")
+        return lines
+
+
+def render_samples(name, kind, help, samples):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{metric_labels(labels.keys(), labels.values())} {value}")
+    return lines
+
+
+# Metric names are part of the alerting contract, do not rename them
+stream_info_seconds = Histogram(
+    "musicbot_get_stream_info_seconds", "Time to get stream info by path", ("path",)
+)
+resolver_path_seconds = Histogram(
+    "musicbot_resolver_path_seconds", "Time taken by each resolver path", ("path",)
+)
+call_play_seconds = Histogram("musicbot_call_play_seconds", "Time taken by call.play")
+thumbnail_fetch_seconds = Histogram(
+    "musicbot_thumbnail_fetch_seconds", "Time to fetch a thumbnail, cached or not"
+)
+mongo_op_seconds = Histogram(
+    "musicbot_mongo_op_seconds", "Time taken by MongoDB operations", ("op",)
+)
+track_gap_seconds = Histogram(
+    "musicbot_track_gap_seconds", "Silence between one track ending and the next playing"
+)
+
+
+async def timed_mongo(op, awaitable):
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        mongo_op_seconds.observe(time.perf_counter() - started, op)
+
+
+def render_metrics():
+    lines = []
+    for histogram in (
+        stream_info_seconds,
+        resolver_path_seconds,
+        call_play_seconds,
+        thumbnail_fetch_seconds,
+        mongo_op_seconds,
+        track_gap_seconds,
+    ):
+        lines += histogram.render()
+    depths = [len(session.queue) for session in sessions.values()]
+    lines += render_samples(
+        "musicbot_active_chats", "gauge", "Chats with an active stream",
+        [({"type": "audio"}, len(sessions.audio)), ({"type": "video"}, len(sessions.video))],
+    )
+    lines += render_samples(
+        "musicbot_queued_tracks", "gauge", "Tracks in all chat queues",
+        [({}, sum(depths))],
+    )
+    lines += render_samples(
+        "musicbot_queue_depth_max", "gauge", "Length of the deepest chat queue",
+        [({}, max(depths, default=0))],
+    )
+    lines += render_samples(
+        "musicbot_outbound_queued", "gauge", "Messages waiting in the outbound scheduler",
+        [({}, outbound_scheduler.stats()["queued"])],
+    )
+    lines += render_samples(
+        "musicbot_floodwaits_total", "counter", "FloodWait errors seen by the outbound scheduler",
+        [({}, outbound_scheduler.flood_waits)],
+    )
+    lines += render_samples(
+        "musicbot_resolver_failures_total", "counter", "Failed resolver path attempts",
+        [({"path": path}, stats["failures"]) for path, stats in resolver_paths.items()],
+    )
+    caches = {
+        "resolver": resolver_cache,
+        "thumbnail": thumbnail_store,
+        "card": card_store,
+        "admin": admin_cache,
+        "photo_id": photo_ids,
+    }
+    lines += render_samples(
+        "musicbot_cache_hits_total", "counter", "Cache hits by cache",
+        [({"cache": name}, cache.hits) for name, cache in caches.items()],
+    )
+    lines += render_samples(
+        "musicbot_cache_misses_total", "counter", "Cache misses by cache",
+        [({"cache": name}, cache.misses) for name, cache in caches.items()],
+    )
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+metrics_runner = None
+
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    server = web.Application()
+    server.router.add_get("/metrics", handle_metrics)
+    metrics_runner = web.AppRunner(server, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logs.info(f"✅ Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    metrics_runner = None
+
+
+# Play Tracing
+
+class Span:
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class PlayTrace:
+    __slots__ = ("chat_id", "query", "started", "finished_at", "outcome", "spans", "total")
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.query = None
+        self.started = time.perf_counter()
+        self.finished_at = None
+        self.outcome = None
+        self.spans = []
+        self.total = 0.0
+
+    def span(self, stage):
+        return Span(self, stage)
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+
+class PlayTracer:
+    """Recent /play traces in a ring buffer, one span per pipeline stage"""
+
+    def __init__(self, maxlen):
+        self.traces = deque(maxlen=maxlen)
+
+    def finish(self, trace, outcome=None):
+        if trace.finished_at is not None:
+            return
+        trace.total = time.perf_counter() - trace.started
+        trace.finished_at = time.time()
+        trace.outcome = outcome or trace.outcome or "aborted"
+        self.traces.append(trace)
+
+    def recent(self, minutes):
+        since = time.time() - minutes * 60
+        return [trace for trace in self.traces if trace.finished_at >= since]
+
+    def stage_stats(self, traces):
+        stages = {}
+        for trace in traces:
+            for stage, seconds in trace.spans + [("total", trace.total)]:
+                stages.setdefault(stage, LatencyStats(maxlen=len(traces) * 2)).record(seconds)
+        return stages
+
+    def slowest(self, traces, limit):
+        return sorted(traces, key=lambda trace: trace.total, reverse=True)[:limit]
+
+
+play_traces = PlayTracer(PERF_TRACE_BUFFER)
+
+
+# Outbound Scheduler
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTICE = 1
+PRIORITY_LOG = 2
+PRIORITY_BROADCAST = 3
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_NOTICE: "notice",
+    PRIORITY_LOG: "log",
+    PRIORITY_BROADCAST: "broadcast",
+}
+# Only new messages count against Telegram's per-chat limit
+CHAT_LIMITED_METHODS = {
+    "send_message", "send_photo", "forward_messages", "copy_message",
+    "reply_text", "reply_photo",
+}
+
+
+class OutboundScheduler:
+    def __init__(self, rate, chat_rate, chat_burst, workers):
+        self.global_bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        # chat_id -> jobs waiting for that chat's next token, in send order
+        self.deferred = {}
+        self.workers = workers
+        self.tasks = []
+        self.queue = None
+        self.sequence = 0
+        self.pause_until = 0.0
+        self.edits = {}
+        self.flood_waits = 0
+        self.coalesced = 0
+        self.delays = {priority: LatencyStats() for priority in PRIORITY_NAMES}
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [
+            asyncio.create_task(self.worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 5000:
+                self.chat_buckets.clear()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst
+            )
+        return bucket
+
+    async def submit(self, priority, chat_id, func, *args, edit_of=None, **kwargs):
+        if not self.tasks:
+            return await func(*args, **kwargs)
+        key = None
+        if edit_of is not None:
+            # A newer edit of a still-queued message replaces the older one
+            key = (edit_of.chat.id, edit_of.id, getattr(func, "__name__", ""))
+            job = self.edits.get(key)
+            if job and not job["started"]:
+                job.update(func=func, args=args, kwargs=kwargs)
+                self.coalesced += 1
+                return await asyncio.shield(job["future"])
+        job = {
+            "priority": priority,
+            "chat_id": chat_id,
+            "func": func,
+            "args": args,
+            "kwargs": kwargs,
+            "key": key,
+            "started": False,
+            "attempts": 0,
+            "queued_at": time.perf_counter(),
+            "future": asyncio.get_running_loop().create_future(),
+        }
+        if key:
+            self.edits[key] = job
+        self.put(job)
+        return await asyncio.shield(job["future"])
+
+    def put(self, job):
+        self.sequence += 1
+        self.queue.put_nowait((job["priority"], self.sequence, job))
+
+    def admit(self, job):
+        """True if the job may run now, else it is parked until its chat has a token"""
+        chat_id = job["chat_id"]
+        waiting = self.deferred.get(chat_id)
+        released = job.pop("released", False)
+        if waiting is not None and not released:
+            waiting.append(job)
+            return False
+        delay = self.chat_bucket(chat_id).take()
+        if delay <= 0:
+            if waiting:
+                asyncio.get_running_loop().call_later(
+                    self.chat_bucket(chat_id).take_delay(), self.release, chat_id
+                )
+            return True
+        if waiting is None:
+            waiting = self.deferred[chat_id] = deque()
+        waiting.appendleft(job)
+        asyncio.get_running_loop().call_later(delay, self.release, chat_id)
+        return False
+
+    def release(self, chat_id):
+        waiting = self.deferred.get(chat_id)
+        if not waiting:
+            self.deferred.pop(chat_id, None)
+            return
+        job = waiting.popleft()
+        if not waiting:
+            del self.deferred[chat_id]
+        job["released"] = True
+        self.put(job)
+
+    async def worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            # A busy chat never holds a worker, its surplus waits off the queue
+            if getattr(job["func"], "__name__", "") in CHAT_LIMITED_METHODS and not self.admit(job):
+                continue
+            job["started"] = True
+            if job["key"] and self.edits.get(job["key"]) is job:
+                self.edits.pop(job["key"], None)
+            while self.pause_until > time.monotonic():
+                await asyncio.sleep(self.pause_until - time.monotonic())
+            await self.global_bucket.acquire()
+            self.delays[job["priority"]].record(time.perf_counter() - job["queued_at"])
+            try:
+                result = await job["func"](*job["args"], **job["kwargs"])
+            except FloodWait as e:
+                # One FloodWait pauses every send, then the job goes back in line
+                self.flood_waits += 1
+                self.pause_until = max(self.pause_until, time.monotonic() + e.value)
+                job["attempts"] += 1
+                if job["attempts"] < OUTBOUND_MAX_RETRIES:
+                    job["started"] = False
+                    self.put(job)
+                elif not job["future"].done():
+                    job["future"].set_exception(e)
+                continue
+            except Exception as e:
+                if not job["future"].done():
+                    job["future"].set_exception(e)
+                continue
+            if not job["future"].done():
+                job["future"].set_result(result)
+
+    def stats(self):
+        return {
+            "queued": (self.queue.qsize() if self.queue else 0)
+            + sum(len(waiting) for waiting in self.deferred.values()),
+            "flood_waits": self.flood_waits,
+            "coalesced": self.coalesced,
+            "delays": {
+                PRIORITY_NAMES[priority]: stats.percentile(95)
+                for priority, stats in self.delays.items()
+            },
+        }
+
+
+outbound_scheduler = OutboundScheduler(
+    OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_WORKERS
+)
+
+
+async def outbound(priority, chat_id, func, *args, **kwargs):
+    return await outbound_scheduler.submit(priority, chat_id, func, *args, **kwargs)
 
 
+# Photo File IDs
 
+fileidsdb = mongodb.tgfileids
 
 
+class PhotoIdCache:
+    def __init__(self, collection):
+        self.collection = collection
+        self.file_ids = {}
+        self.digests = {}
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
 
+    async def load(self):
+        async for doc in self.collection.find({}, {"_id": 1, "file_id": 1}):
+            self.file_ids[doc["_id"]] = doc["file_id"]
+
+    def source_key(self, source):
+        # URLs are their own key, local files are keyed by content hash
+        if not isinstance(source, str) or not os.path.isfile(source):
+            return source if isinstance(source, str) else None
+        stat = os.stat(source)
+        cached = self.digests.get(source)
+        if cached and cached[0] == (stat.st_mtime, stat.st_size):
+            return cached[1]
+        with open(source, "rb") as file:
+            digest = "sha1:" + hashlib.sha1(file.read()).hexdigest()
+        self.digests[source] = ((stat.st_mtime, stat.st_size), digest)
+        return digest
+
+    def get(self, key):
+        file_id = self.file_ids.get(key) if key else None
+        if file_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return file_id
+
+    def put(self, key, file_id):
+        if not key or self.file_ids.get(key) == file_id:
+            return
+        self.file_ids[key] = file_id
+        fire_and_forget(timed_mongo("photo_id_put", self.collection.update_one(
+            {"_id": key}, {"$set": {"file_id": file_id}}, upsert=True
+        )))
+
+    def drop(self, key):
+        self.rejected += 1
+        self.file_ids.pop(key, None)
+        fire_and_forget(timed_mongo("photo_id_drop", self.collection.delete_one({"_id": key})))
+
+
+photo_ids = PhotoIdCache(fileidsdb)
+
+
+# Only these mean the id itself is bad, anything else is about the chat
+STALE_FILE_ID_ERRORS = (
+    FileIdInvalid,
+    FileReferenceExpired,
+    FileReferenceInvalid,
+    MediaEmpty,
+    ValueError,
+)
+
+
+async def send_cached_photo(client, chat_id, photo, priority=PRIORITY_INTERACTIVE, **kwargs):
+    try:
+        key = photo_ids.source_key(photo)
+    except OSError:
+        key = None
+    file_id = photo_ids.get(key)
+    if file_id:
+        try:
+            return await outbound(priority, chat_id, client.send_photo, chat_id, photo=file_id, **kwargs)
+        except STALE_FILE_ID_ERRORS:
+            # Telegram rejected the stored id, forget it and upload again
+            photo_ids.drop(key)
+    m = await outbound(priority, chat_id, client.send_photo, chat_id, photo=photo, **kwargs)
+    if key and m and m.photo:
+        photo_ids.put(key, m.photo.file_id)
+    return m
 
 
 async def main():
@@ -185,6 +922,13 @@ async def main():
         os.mkdir("cache")
     if "downloads" not in os.listdir():
         os.mkdir("downloads")
+    # Thumbnails from before the thumbnail store were never cleaned up
+    for file in os.listdir("cache"):
+        if file.startswith("temp_") and file.endswith(".png"):
+            os.remove(os.path.join("cache", file))
+    thumbnail_store.load()
+    card_store.load()
+    start_card_pool()
     for file in os.listdir():
         if file.endswith(".session"):
             os.remove(file)
@@ -196,6 +940,17 @@ async def main():
     except Exception:
         logs.info("⚠️ 'MONGO_DB_URL' - Not Valid !!")
         sys.exit()
+    await load_served_registries()
+    await photo_ids.load()
+    await invite_links.load()
+    await assistants.load()
+    background_tasks.append(asyncio.create_task(run_registry_flusher()))
+    background_tasks.append(asyncio.create_task(run_queue_lookahead()))
+    background_tasks.append(asyncio.create_task(run_log_reporter()))
+    get_http_client()
+    get_media_session()
+    outbound_scheduler.start()
+    await start_metrics_server()
         
     try:
         await bot.start()
@@ -204,36 +959,57 @@ async def main():
         sys.exit()
     if LOG_GROUP_ID != 0:
         try:
-            await bot.send_message(
-                LOG_GROUP_ID, "**✅ Bot Started.**"
+            await outbound(
+                PRIORITY_LOG, LOG_GROUP_ID, bot.send_message, LOG_GROUP_ID, "**✅ Bot Started.**"
             )
         except Exception:
             pass
     logs.info("✅ Bot Started❗")
-    try:
-        await app.start()
-    except Exception as e:
-        logs.info(f"🚫 Failed to start Assistant❗\n⚠️ Reason: {e}")
+    if not await assistants.start():
+        logs.info("🚫 Failed to start any Assistant❗")
         sys.exit()
-    try:
-        await app.join_chat("source_code_network")
-   
-    except Exception:
-        pass
-    if LOG_GROUP_ID != 0:
+    for assistant in assistants.healthy():
         try:
-            await app.send_message(
-                LOG_GROUP_ID, "**✅ Assistant Started.**"
-            )
+            await assistant.client.join_chat("source_code_network")
         except Exception:
             pass
-    logs.info("✅ Assistant Started❗")
-    try:
-        await call.start()
-    except Exception as e:
-        logs.info(f"🚫 Failed to start PyTgCalls❗\n⚠️ Reason: {e}")
-        sys.exit()
+        if LOG_GROUP_ID != 0:
+            try:
+                await assistant.client.send_message(
+                    LOG_GROUP_ID, f"**✅ Assistant {assistant.name} Started.**"
+                )
+            except Exception:
+                pass
+    logs.info(f"✅ {len(assistants.healthy())} Assistant(s) Started❗")
+    background_tasks.append(asyncio.create_task(run_assistant_health()))
+    if CALL_WORKERS:
+        background_tasks.append(asyncio.create_task(run_call_supervisor()))
+    await restore_sessions()
+    background_tasks.append(asyncio.create_task(run_session_snapshots()))
+    await resume_broadcasts()
     await idle()
+    await shutdown()
+
+
+async def shutdown():
+    # Unfinished broadcasts stay 'running' in Mongo and resume on next start
+    tasks = background_tasks + list(broadcast_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await flush_served_registries()
+    await save_session_snapshots()
+    try:
+        await asyncio.wait_for(flush_log_events(), timeout=10)
+    except Exception:
+        pass
+    await asyncio.gather(*pending_writes, return_exceptions=True)
+    await outbound_scheduler.stop()
+    await stop_metrics_server()
+    await close_http_client()
+    await close_media_session()
+    stop_card_pool()
+    stop_call_workers()
 
 
 
@@ -285,6 +1061,99 @@ def format_views(views) -> str:
 
 
 
+# Admin Cache
+
+def can_manage_stream(member):
+    try:
+        return bool(member and member.privileges.can_manage_video_chats)
+    except Exception:
+        return False
+
+
+class AdminCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.warmed = {}
+        self.hits = 0
+        self.misses = 0
+        self.warmups = 0
+
+    def lookup(self, chat_id, user_id):
+        now = time.monotonic()
+        entry = self.entries.get((chat_id, user_id))
+        if entry and entry[0] > now:
+            return entry[1]
+        # A fresh admin list covers everyone who is not on it
+        if self.warmed.get(chat_id, 0) > now:
+            return False
+        return None
+
+    def get(self, chat_id, user_id):
+        allowed = self.lookup(chat_id, user_id)
+        if allowed is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return allowed
+
+    def put(self, chat_id, user_id, allowed):
+        now = time.monotonic()
+        if len(self.entries) > 10000:
+            self.entries = {
+                key: entry for key, entry in self.entries.items() if entry[0] > now
+            }
+        self.entries[(chat_id, user_id)] = (now + self.ttl, allowed)
+
+    def invalidate(self, chat_id, user_id=None):
+        self.warmed.pop(chat_id, None)
+        if user_id is not None:
+            self.entries.pop((chat_id, user_id), None)
+
+    async def warm(self, chat_id):
+        if self.warmed.get(chat_id, 0) > time.monotonic():
+            return
+        async for member in bot.get_chat_members(
+            chat_id, filter=ChatMembersFilter.ADMINISTRATORS
+        ):
+            if member.user:
+                self.put(chat_id, member.user.id, can_manage_stream(member))
+        self.warmed[chat_id] = time.monotonic() + self.ttl
+        self.warmups += 1
+
+    async def is_allowed(self, chat_id, user_id):
+        allowed = self.get(chat_id, user_id)
+        if allowed is not None:
+            return allowed
+        if ADMIN_CACHE_WARMUP:
+            try:
+                await self.warm(chat_id)
+                # Not counted, this lookup is the miss that was just recorded
+                return self.lookup(chat_id, user_id)
+            except Exception:
+                pass
+        try:
+            member = await bot.get_chat_member(chat_id, user_id)
+        except Exception:
+            return False
+        allowed = can_manage_stream(member)
+        self.put(chat_id, user_id, allowed)
+        return allowed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "warmups": self.warmups,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL)
+
+
 def chat_admins_only(mystic):
     async def wrapper(client, message):
         if message.sender_chat:
@@ -293,21 +1162,12 @@ def chat_admins_only(mystic):
                 
         if message.from_user:
             if message.from_user.id != OWNER_ID:
-                try:
-                    member = await bot.get_chat_member(
-                        message.chat.id, message.from_user.id
-                    )
-                except Exception:
-                    return
-                if not member:
-                    return
-                try:
-                    if not member.privileges.can_manage_video_chats:
-                        return
-                except Exception:
+                if not await admin_cache.is_allowed(
+                    message.chat.id, message.from_user.id
+                ):
                     return
         try:
-            await message.delete()
+            await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.delete)
         except Exception:
             pass
             
@@ -316,294 +1176,1913 @@ def chat_admins_only(mystic):
     return wrapper
 
 
-async def get_stream_info(query, streamtype):
-    """Get stream information using py-yt-search and the new API"""
-    try:
-        # Check if the query is a URL
-        is_url = query.startswith(('http://', 'https://', 'www.', 'youtube.com', 'youtu.be'))
-        
-        # Use direct API with query parameter if it's not a URL
-        api_url = "https://yt-api-production-fc4c.up.railway.app"
-        api_key = "cbm_e40ef459f0274be1ad541a19f95fd367"
-        endpoint = "/video" if streamtype.lower() == "video" else "/audio"
-        
-        if not is_url:
-            # Direct query to the API
-            try:
-                async with httpx.AsyncClient(timeout=60) as client:
-                    response = await client.get(
-                        f"{api_url}{endpoint}",
-                        params={"query": query},
-                        headers={"X-API-Key": api_key},
-                        follow_redirects=True
-                    )
-                    response.raise_for_status()
-                    stream_data = response.json()
-                    
-                    # Get view count and clean it to avoid parsing issues with commas
-                    view_count = str(stream_data.get('view_count', 0))
-                    # Clean up the view count in case it has commas or 'views' text
-                    if ',' in view_count or ' views' in view_count.lower():
-                        view_count = view_count.replace(',', '').split()[0]
-                    
-                    video_id = stream_data.get('id', '')
-                    video_link = f"https://www.youtube.com/watch?v={video_id}" if video_id else ""
-                    
-                    return {
-                        "id": video_id,
-                        "title": stream_data.get('title'),
-                        "duration": stream_data.get('duration'),
-                        "link": video_link,
-                        "channel": stream_data.get('uploader') or stream_data.get('channel'),
-                        "views": view_count,
-                        "thumbnail": stream_data.get('thumbnail'),
-                        "stream_url": stream_data.get('stream_url'),
-                        "stream_type": stream_data.get('stream_type') or (
-                            "Video" if streamtype.lower() == "video" else "Audio"
-                        )
-                    }
-            except Exception as e:
-                print(f"Direct API query failed: {str(e)}, falling back to search method")
-                # Fall back to search method
-                pass
-        
-        # If direct query failed or we have a URL, use the search method
-        from py_yt import Search, VideosSearch
-        
-        _search = Search(query, limit=1, language='en', region='IN')
-        result = await _search.next()
-        
-        if not result or not result.get('result'):
-            print("No search results found")
-            return {}
-            
-        video_info = result['result'][0]
-        
-        # Check if the result is a channel instead of a video
-        if video_info.get('type') == 'channel':
-            print("Search returned a channel, trying more specific search")
-            # Try searching with more specific terms
-            _search = Search(f"{query} music", limit=1, language='en', region='IN')
-            result = await _search.next()
-            if not result or not result.get('result'):
-                return {}
-            video_info = result['result'][0]
-        
-        # Now we should have a video ID
-        video_id = video_info.get('id')
-        if not video_id:
-            print("Could not find video ID in search results")
-            return {}
-            
-        video_link = f"https://www.youtube.com/watch?v={video_id}"
-        
-        # Extract video details from search results for fallback
-        title = video_info.get('title', '')
-            
-        # Extract duration safely
-        duration = 0
-        if 'duration' in video_info:
-            duration_dict = video_info.get('duration')
-            if isinstance(duration_dict, dict) and 'secondsText' in duration_dict:
-                try:
-                    duration = int(duration_dict.get('secondsText', '0'))
-                except (ValueError, TypeError):
-                    duration = 0
-        
-        # Extract channel name safely
-        channel_name = ""
-        if 'channel' in video_info:
-            channel_info = video_info.get('channel')
-            if isinstance(channel_info, dict):
-                channel_name = channel_info.get('name', '')            # Extract view count safely
-            view_count = "0"
-            if 'viewCount' in video_info:
-                view_count_info = video_info.get('viewCount')
-                if isinstance(view_count_info, dict):
-                    view_count = view_count_info.get('text', '0')
-                    # Clean up the view count in case it has commas or 'views' text
-                    if ',' in view_count or ' views' in view_count.lower():
-                        view_count = view_count.replace(',', '').split()[0]
-        
-        # Extract thumbnail safely
-        thumbnail_url = ""
-        if 'thumbnails' in video_info and video_info['thumbnails']:
-            thumbnails = video_info.get('thumbnails')
-            if isinstance(thumbnails, list) and len(thumbnails) > 0:
-                thumbnail_url = thumbnails[0].get('url', '')
-        
-        # Now get the stream URL from the API using video link
-        api_url = "https://yt-api-production-fc4c.up.railway.app"
-        api_key = "cbm_e40ef459f0274be1ad541a19f95fd367"
-        endpoint = "/video" if streamtype.lower() == "video" else "/audio"
-        
-        try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                response = await client.get(
-                    f"{api_url}{endpoint}",
-                    params={"url": video_link},
-                    headers={"X-API-Key": api_key},
-                    follow_redirects=True
-                )
-                response.raise_for_status()
-                stream_data = response.json()
-                
-                # Get view count and clean it to avoid parsing issues with commas
-                view_count = str(stream_data.get('view_count', 0))
-                # Clean up the view count in case it has commas or 'views' text
-                if ',' in view_count or ' views' in view_count.lower():
-                    view_count = view_count.replace(',', '').split()[0]
-                
-                return {
-                    "id": stream_data.get('id'),
-                    "title": stream_data.get('title'),
-                    "duration": stream_data.get('duration'),
-                    "link": video_link,
-                    "channel": stream_data.get('uploader') or stream_data.get('channel'),
-                    "views": view_count,
-                    "thumbnail": stream_data.get('thumbnail'),
-                    "stream_url": stream_data.get('stream_url'),
-                    "stream_type": stream_data.get('stream_type') or (
-                        "Video" if streamtype.lower() == "video" else "Audio"
-                    )
-                }
-        except Exception as e:
-            print(f"API connection error: {str(e)}")
-            # Fall back to using video info extracted earlier
-            fallback_data = {
-                "id": video_id,
-                "title": title,
-                "duration": duration,
-                "link": video_link,
-                "channel": channel_name,
-                "views": view_count,
-                "thumbnail": thumbnail_url,
-                "stream_url": "",  # No stream URL available in fallback
-                "stream_type": "Video" if streamtype.lower() == "video" else "Audio"
-            }
-            return fallback_data
-            
-    except Exception as e:
-        print(f"Error in get_stream_info: {str(e)}")
-        return {}
+# Stream API Client
 
+http_client = None
+http_inflight = 0
+http_peak_inflight = 0
 
 
-async def is_stream_off(chat_id: int) -> bool:
-    mode = paused.get(chat_id)
-    if not mode:
-        return False
-    return mode
+def create_http_client():
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            HTTP_READ_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            pool=HTTP_CONNECT_TIMEOUT,
+        ),
+    )
 
 
-async def stream_on(chat_id: int):
-    paused[chat_id] = False
+def get_http_client():
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client()
+    return http_client
 
 
-async def stream_off(chat_id: int):
-    paused[chat_id] = True
+async def close_http_client():
+    global http_client
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
+    http_client = None
 
 
-async def get_call_status(chat_id):
-    pass
+async def fetch_stream_api(endpoint, params):
+    global http_inflight, http_peak_inflight
+    client = get_http_client()
+    http_inflight += 1
+    http_peak_inflight = max(http_peak_inflight, http_inflight)
+    try:
+        response = await client.get(
+            f"{STREAM_API_URL}{endpoint}",
+            params=params,
+            headers={"X-API-Key": STREAM_API_KEY},
+        )
+        response.raise_for_status()
+        return response.json()
+    finally:
+        http_inflight -= 1
+
+
+def http_pool_stats():
+    stats = {
+        "http2": False,
+        "connections": 0,
+        "idle": 0,
+        "inflight": http_inflight,
+        "peak_inflight": http_peak_inflight,
+        "max_connections": HTTP_MAX_CONNECTIONS,
+    }
+    if http_client is None or http_client.is_closed:
+        return stats
+    # httpx has no public pool introspection, read the httpcore pool directly
+    try:
+        pool = http_client._transport._pool
+        connections = list(pool.connections)
+        stats["http2"] = getattr(pool, "_http2", False)
+        stats["connections"] = len(connections)
+        stats["idle"] = sum(1 for conn in connections if conn.is_idle())
+    except Exception:
+        pass
+    return stats
 
 
+# Resolver Cache
 
-    
+def normalize_query(query):
+    return " ".join(str(query).lower().split())
 
-async def add_active_media_chat(chat_id, stream_type):
-    if stream_type == "Audio":
-        if chat_id in active_video_chats:
-            active_video_chats.remove(chat_id)
-        if chat_id not in active_audio_chats:
-            active_audio_chats.append(chat_id)
-    elif stream_type == "Video":
-        if chat_id in active_audio_chats:
-            active_audio_chats.remove(chat_id)
-        if chat_id not in active_video_chats:
-            active_video_chats.append(chat_id)
-    if chat_id not in active_media_chats:
-        active_media_chats.append(chat_id)
-
-
-async def remove_active_media_chat(chat_id):
-    if chat_id in active_audio_chats:
-        active_audio_chats.remove(chat_id)
-    if chat_id in active_video_chats:
-        active_video_chats.remove(chat_id)
-    if chat_id in active_media_chats:
-        active_media_chats.remove(chat_id)
 
-async def fetch_and_save_image(url, save_path):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                async with aiofiles.open(save_path, mode="wb") as file:
-                    await file.write(await resp.read())
-                return save_path
+def stream_url_expiry(stream_url):
+    # googlevideo links carry their expiry either as '?expire=' or '/expire/'
+    if not stream_url:
+        return None
+    try:
+        expire = parse_qs(urlparse(stream_url).query).get("expire")
+        if expire:
+            return int(expire[0])
+        match = re.search(r"/expire/(\d+)", stream_url)
+        if match:
+            return int(match.group(1))
+    except (ValueError, TypeError):
+        pass
     return None
 
 
-async def put_queue(
-    chat_id,
-    media_stream,
-    thumbnail,
-    title,
-    duration,
-    stream_type,
-    chat_link,
-    mention,
-):
-    put = {
-        "media_stream": media_stream,
-        "thumbnail": thumbnail,
-        "title": title,
-        "duration": duration,
-        "stream_type": stream_type,
-        "chat_link": chat_link,
-        "mention": mention,
+class ResolverCache:
+    def __init__(self, maxsize, ttl, margin):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.margin = margin
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(query, streamtype):
+        return (normalize_query(query), streamtype.lower())
+
+    def get(self, query, streamtype):
+        key = self.make_key(query, streamtype)
+        entry = self.entries.get(key)
+        if entry:
+            expires_at, info = entry
+            if expires_at > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(info)
+            self.entries.pop(key, None)
+        self.misses += 1
+        return None
+
+    def put(self, query, streamtype, info):
+        # Results without a playable URL are search fallbacks, never cache them
+        stream_url = info.get("stream_url") if info else None
+        if not stream_url or self.maxsize <= 0:
+            return
+        now = time.time()
+        expires_at = now + self.ttl
+        expiry = stream_url_expiry(stream_url)
+        if expiry:
+            expires_at = min(expires_at, expiry - self.margin)
+        if expires_at <= now:
+            return
+        key = self.make_key(query, streamtype)
+        self.entries[key] = (expires_at, dict(info))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, query, streamtype):
+        return self.entries.pop(self.make_key(query, streamtype), None) is not None
+
+    def invalidate_url(self, stream_url):
+        stale = [
+            key for key, (_, info) in self.entries.items()
+            if info.get("stream_url") == stream_url
+        ]
+        for key in stale:
+            self.entries.pop(key, None)
+        return len(stale)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+resolver_cache = ResolverCache(
+    RESOLVER_CACHE_SIZE, RESOLVER_CACHE_TTL, RESOLVER_CACHE_MARGIN
+)
+
+
+# Single-Flight Resolution
+
+class SingleFlight:
+    def __init__(self):
+        self.inflight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _forget(self, key, task):
+        if self.inflight.get(key) is task:
+            self.inflight.pop(key, None)
+        # Mark the exception as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func, *args):
+        task = self.inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(func(*args))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # Shielded so one cancelled waiter does not cancel the shared call
+        result = await asyncio.shield(task)
+        return dict(result) if isinstance(result, dict) else result
+
+    def stats(self):
+        calls = self.leaders + self.coalesced
+        return {
+            "inflight": len(self.inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesce_ratio": (self.coalesced / calls) if calls else 0.0,
+        }
+
+
+resolver_flight = SingleFlight()
+
+
+async def get_stream_info(query, streamtype):
+    """Get stream information, served from the resolver cache when fresh"""
+    started = time.perf_counter()
+    info = resolver_cache.get(query, streamtype)
+    path = "cache"
+    if not info:
+        path = "resolver"
+        key = resolver_cache.make_key(query, streamtype)
+        info = await resolver_flight.do(key, resolve_and_cache, query, streamtype)
+    elapsed = time.perf_counter() - started
+    resolve_latency.record(elapsed)
+    stream_info_seconds.observe(elapsed, path)
+    return info
+
+
+async def resolve_and_cache(query, streamtype):
+    info = await resolve_stream_info(query, streamtype)
+    resolver_cache.put(query, streamtype, info)
+    return info
+
+
+# Hedged Resolution
+
+resolver_paths = {
+    path: {
+        "started": 0,
+        "wins": 0,
+        "failures": 0,
+        "cancelled": 0,
+        "latency": LatencyStats(),
     }
-    check = queues.get(chat_id)
-    if check:
-        queues[chat_id].append(put)
-    else:
-        queues[chat_id] = []
-        queues[chat_id].append(put)
-    
-    return len(queues[chat_id]) - 1
+    for path in ("direct", "search")
+}
+
+
+def is_usable_info(info):
+    return bool(info and info.get("stream_url"))
+
+
+def start_resolver_path(path, coro):
+    stats = resolver_paths[path]
+    stats["started"] += 1
+
+    async def timed():
+        started = time.perf_counter()
+        try:
+            info = await coro
+        except asyncio.CancelledError:
+            stats["cancelled"] += 1
+            raise
+        except Exception as e:
+            stats["failures"] += 1
+            logs.error(f"Resolver path '{path}' failed: {str(e)}")
+            return {}
+        elapsed = time.perf_counter() - started
+        stats["latency"].record(elapsed)
+        resolver_path_seconds.observe(elapsed, path)
+        if not is_usable_info(info):
+            stats["failures"] += 1
+        return info
+
+    return asyncio.ensure_future(timed())
+
+
+async def resolve_stream_info(query, streamtype):
+    """Resolve a query, hedging the direct API call with the search path"""
+    # Check if the query is a URL
+    is_url = query.startswith(('http://', 'https://', 'www.', 'youtube.com', 'youtu.be'))
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RESOLVE_DEADLINE
+    hedge_at = loop.time() + RESOLVE_HEDGE_DELAY
+    pending = {}
+    fallback = {}
+    search_started = is_url
+    if is_url:
+        pending[start_resolver_path("search", resolve_via_search(query, streamtype))] = "search"
+    else:
+        pending[start_resolver_path("direct", resolve_direct(query, streamtype))] = "direct"
+    try:
+        while pending:
+            now = loop.time()
+            if now >= deadline:
+                logs.info(f"Resolution deadline hit for: {query}")
+                break
+            wait_until = deadline if search_started else min(deadline, hedge_at)
+            done, _ = await asyncio.wait(
+                pending, timeout=max(0, wait_until - now),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                path = pending.pop(task)
+                info = task.result()
+                if is_usable_info(info):
+                    resolver_paths[path]["wins"] += 1
+                    return info
+                if info and not fallback:
+                    fallback = info
+            # Hedge once the direct call is slow, or straight away if it failed
+            if not search_started and (not pending or loop.time() >= hedge_at):
+                search_started = True
+                pending[start_resolver_path("search", resolve_via_search(query, streamtype))] = "search"
+    finally:
+        for task in pending:
+            task.cancel()
+    return fallback
+
+
+async def resolve_direct(query, streamtype):
+    """Get stream information by querying the API directly"""
+    endpoint = "/video" if streamtype.lower() == "video" else "/audio"
+    stream_data = await fetch_stream_api(endpoint, {"query": query})
+
+    # Get view count and clean it to avoid parsing issues with commas
+    view_count = str(stream_data.get('view_count', 0))
+    # Clean up the view count in case it has commas or 'views' text
+    if ',' in view_count or ' views' in view_count.lower():
+        view_count = view_count.replace(',', '').split()[0]
+
+    video_id = stream_data.get('id', '')
+    video_link = f"https://www.youtube.com/watch?v={video_id}" if video_id else ""
+
+    return {
+        "id": video_id,
+        "title": stream_data.get('title'),
+        "duration": stream_data.get('duration'),
+        "link": video_link,
+        "channel": stream_data.get('uploader') or stream_data.get('channel'),
+        "views": view_count,
+        "thumbnail": stream_data.get('thumbnail'),
+        "stream_url": stream_data.get('stream_url'),
+        "stream_type": stream_data.get('stream_type') or (
+            "Video" if streamtype.lower() == "video" else "Audio"
+        )
+    }
+
+
+async def resolve_via_search(query, streamtype):
+    """Get stream information using py-yt-search and the API"""
+    from py_yt import Search, VideosSearch
+
+    _search = Search(query, limit=1, language='en', region='IN')
+    result = await _search.next()
+
+    if not result or not result.get('result'):
+        logs.info("No search results found")
+        return {}
+
+    video_info = result['result'][0]
+
+    # Check if the result is a channel instead of a video
+    if video_info.get('type') == 'channel':
+        logs.info("Search returned a channel, trying more specific search")
+        # Try searching with more specific terms
+        _search = Search(f"{query} music", limit=1, language='en', region='IN')
+        result = await _search.next()
+        if not result or not result.get('result'):
+            return {}
+        video_info = result['result'][0]
+
+    # Now we should have a video ID
+    video_id = video_info.get('id')
+    if not video_id:
+        logs.info("Could not find video ID in search results")
+        return {}
+
+    video_link = f"https://www.youtube.com/watch?v={video_id}"
+
+    # Extract video details from search results for fallback
+    title = video_info.get('title', '')
+
+    # Extract duration safely
+    duration = 0
+    if 'duration' in video_info:
+        duration_dict = video_info.get('duration')
+        if isinstance(duration_dict, dict) and 'secondsText' in duration_dict:
+            try:
+                duration = int(duration_dict.get('secondsText', '0'))
+            except (ValueError, TypeError):
+                duration = 0
+
+    # Extract channel name safely
+    channel_name = ""
+    if 'channel' in video_info:
+        channel_info = video_info.get('channel')
+        if isinstance(channel_info, dict):
+            channel_name = channel_info.get('name', '')
+
+    # Extract view count safely
+    view_count = "0"
+    if 'viewCount' in video_info:
+        view_count_info = video_info.get('viewCount')
+        if isinstance(view_count_info, dict):
+            view_count = view_count_info.get('text', '0')
+            # Clean up the view count in case it has commas or 'views' text
+            if ',' in view_count or ' views' in view_count.lower():
+                view_count = view_count.replace(',', '').split()[0]
+
+    # Extract thumbnail safely
+    thumbnail_url = ""
+    if 'thumbnails' in video_info and video_info['thumbnails']:
+        thumbnails = video_info.get('thumbnails')
+        if isinstance(thumbnails, list) and len(thumbnails) > 0:
+            thumbnail_url = thumbnails[0].get('url', '')
+
+    # Now get the stream URL from the API using video link
+    endpoint = "/video" if streamtype.lower() == "video" else "/audio"
+
+    try:
+        stream_data = await fetch_stream_api(endpoint, {"url": video_link})
+
+        # Get view count and clean it to avoid parsing issues with commas
+        view_count = str(stream_data.get('view_count', 0))
+        # Clean up the view count in case it has commas or 'views' text
+        if ',' in view_count or ' views' in view_count.lower():
+            view_count = view_count.replace(',', '').split()[0]
+
+        return {
+            "id": stream_data.get('id'),
+            "title": stream_data.get('title'),
+            "duration": stream_data.get('duration'),
+            "link": video_link,
+            "channel": stream_data.get('uploader') or stream_data.get('channel'),
+            "views": view_count,
+            "thumbnail": stream_data.get('thumbnail'),
+            "stream_url": stream_data.get('stream_url'),
+            "stream_type": stream_data.get('stream_type') or (
+                "Video" if streamtype.lower() == "video" else "Audio"
+            )
+        }
+    except Exception as e:
+        logs.error(f"API connection error: {str(e)}")
+        # Fall back to using video info extracted earlier
+        fallback_data = {
+            "id": video_id,
+            "title": title,
+            "duration": duration,
+            "link": video_link,
+            "channel": channel_name,
+            "views": view_count,
+            "thumbnail": thumbnail_url,
+            "stream_url": "",  # No stream URL available in fallback
+            "stream_type": "Video" if streamtype.lower() == "video" else "Audio"
+        }
+        return fallback_data
+
+
+
+async def is_stream_off(chat_id: int) -> bool:
+    session = sessions.get(chat_id)
+    return bool(session and session.paused)
+
+
+async def stream_on(chat_id: int):
+    sessions.set_paused(chat_id, False)
+
+
+async def stream_off(chat_id: int):
+    sessions.set_paused(chat_id, True)
+
+
+async def get_call_status(chat_id):
+    pass
+
+
+
+    
+
+async def add_active_media_chat(chat_id, stream_type):
+    sessions.set_stream_type(chat_id, stream_type)
+
+
+# Media Downloader
+
+media_session = None
+download_stats = {}
+
+
+def get_media_session():
+    global media_session
+    if media_session is None or media_session.closed:
+        media_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=DOWNLOAD_MAX_CONNECTIONS,
+                limit_per_host=DOWNLOAD_MAX_PER_HOST,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=DOWNLOAD_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT
+            ),
+        )
+    return media_session
+
+
+async def close_media_session():
+    global media_session
+    if media_session is not None and not media_session.closed:
+        await media_session.close()
+    media_session = None
+
+
+def host_download_stats(host):
+    stats = download_stats.get(host)
+    if stats is None:
+        stats = download_stats[host] = {
+            "requests": 0,
+            "failures": 0,
+            "bytes": 0,
+            "latency": LatencyStats(maxlen=200),
+        }
+    return stats
+
+
+async def fetch_and_save_image(url, save_path):
+    stats = host_download_stats(urlparse(url).hostname or "unknown")
+    stats["requests"] += 1
+    temp_path = f"{save_path}.part"
+    started = time.perf_counter()
+    size = 0
+    try:
+        async with get_media_session().get(url) as resp:
+            if resp.status != 200:
+                stats["failures"] += 1
+                return None
+            if (resp.content_length or 0) > DOWNLOAD_MAX_BYTES:
+                stats["failures"] += 1
+                return None
+            # Stream to disk so memory stays flat whatever the image size
+            async with aiofiles.open(temp_path, mode="wb") as file:
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > DOWNLOAD_MAX_BYTES:
+                        stats["failures"] += 1
+                        return None
+                    await file.write(chunk)
+        os.replace(temp_path, save_path)
+    except Exception:
+        stats["failures"] += 1
+        raise
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    stats["bytes"] += size
+    stats["latency"].record(time.perf_counter() - started)
+    return save_path
+
+
+# Thumbnail Store
+
+class ThumbnailStore:
+    def __init__(self, directory, max_bytes, max_files, suffix=".png"):
+        self.directory = directory
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flight = SingleFlight()
+
+    def path_for(self, key):
+        safe_key = re.sub(r"[^A-Za-z0-9_-]", "_", str(key))
+        return os.path.join(self.directory, f"{safe_key}{self.suffix}")
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, path, stat.st_size))
+        # Oldest first so the OrderedDict keeps LRU order across restarts
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+            self.total_bytes += size
+        self.evict()
+
+    def evict(self):
+        while self.entries and (
+            self.total_bytes > self.max_bytes or len(self.entries) > self.max_files
+        ):
+            path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def fetch(self, video_id, url):
+        if not video_id or not url:
+            return None
+        started = time.perf_counter()
+        try:
+            return await self.produce(
+                video_id, lambda temp_path: fetch_and_save_image(url, temp_path)
+            )
+        finally:
+            thumbnail_fetch_seconds.observe(time.perf_counter() - started)
+
+    async def produce(self, key, producer):
+        path = self.path_for(key)
+        if path in self.entries and os.path.exists(path):
+            self.hits += 1
+            self.entries.move_to_end(path)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return path
+        self.misses += 1
+        return await self.flight.do(path, self.store, path, producer)
+
+    async def store(self, path, producer):
+        temp_path = f"{path}.{os.getpid()}.part"
+        try:
+            if not await producer(temp_path):
+                return None
+            os.replace(temp_path, path)
+        except Exception as e:
+            logs.error(f"Failed to store '{path}': {e}")
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        size = os.path.getsize(path)
+        self.total_bytes += size - self.entries.pop(path, 0)
+        self.entries[path] = size
+        self.evict()
+        return path if path in self.entries else None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "files": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+thumbnail_store = ThumbnailStore(
+    os.path.join("cache", "thumbs"),
+    THUMB_CACHE_MAX_MB * 1024 * 1024,
+    THUMB_CACHE_MAX_FILES,
+)
+
+
+# Now Playing Cards
+
+CARD_SIZE = (1280, 720)
+CARD_LAYOUT = "np2"
+
+card_pool = None
+card_fonts = {}
+card_template = None
+
+
+def load_card_font(font_path, size):
+    if font_path:
+        try:
+            return ImageFont.truetype(font_path, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def init_card_worker(font_path):
+    """Load fonts and the shading template once per renderer process"""
+    global card_template
+    card_fonts["label"] = load_card_font(font_path, 30)
+    card_fonts["title"] = load_card_font(font_path, 54)
+    card_fonts["meta"] = load_card_font(font_path, 36)
+    # Left-to-right shade so the text column stays readable on any artwork
+    shade = np.linspace(110, 230, CARD_SIZE[0], dtype=np.uint8)
+    alpha = np.tile(shade, (CARD_SIZE[1], 1))
+    card_template = Image.new("RGBA", CARD_SIZE, (0, 0, 0, 255))
+    card_template.putalpha(Image.fromarray(alpha, mode="L"))
+
+
+def render_now_playing(save_path, thumbnail_path, title, duration):
+    if card_template is None:
+        init_card_worker(CARD_FONT)
+    with Image.open(thumbnail_path) as source:
+        source = source.convert("RGB")
+
+    background = ImageOps.fit(source, CARD_SIZE).filter(ImageFilter.GaussianBlur(28))
+    background = ImageEnhance.Brightness(background).enhance(0.7)
+    card = Image.alpha_composite(background.convert("RGBA"), card_template)
+
+    art = ImageOps.fit(source, (560, 560))
+    mask = Image.new("L", art.size, 0)
+    ImageDraw.Draw(mask).rounded_rectangle((0, 0, *art.size), radius=40, fill=255)
+    card.paste(art, (80, 80), mask)
+
+    draw = ImageDraw.Draw(card)
+    x, y = 710, 150
+    draw.text((x, y), "NOW PLAYING", font=card_fonts["label"], fill=(255, 255, 255, 170))
+    y += 70
+    lines = textwrap.wrap(title or "Unknown", width=18) or ["Unknown"]
+    if len(lines) > 3:
+        lines = lines[:3]
+        lines[-1] = lines[-1][:15] + "..."
+    for line in lines:
+        draw.text((x, y), line, font=card_fonts["title"], fill="white")
+        y += 66
+    y += 30
+    draw.text((x, y), f"Duration: {duration}", font=card_fonts["meta"], fill=(230, 230, 230))
+
+    card.convert("RGB").save(save_path, "JPEG", quality=82, optimize=True, progressive=True)
+    return save_path
+
+
+def start_card_pool():
+    global card_pool
+    if CARD_WORKERS <= 0 or card_pool is not None:
+        return
+    card_pool = ProcessPoolExecutor(
+        max_workers=CARD_WORKERS,
+        # Forking the running process would copy pymongo's and asyncio's threads
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_card_worker,
+        initargs=(CARD_FONT,),
+    )
+
+
+def stop_card_pool():
+    global card_pool
+    if card_pool is not None:
+        card_pool.shutdown(wait=False, cancel_futures=True)
+    card_pool = None
+
+
+card_store = ThumbnailStore(
+    os.path.join("cache", "cards"),
+    CARD_CACHE_MAX_MB * 1024 * 1024,
+    THUMB_CACHE_MAX_FILES,
+    suffix=".jpg",
+)
+
+
+async def render_stream_card(video_id, thumbnail_path, title, duration):
+    if card_pool is None or not video_id:
+        return None
+    # Only track details are drawn, so a repeated track is never re-rendered
+    key = f"{video_id}_{CARD_LAYOUT}"
+    loop = asyncio.get_running_loop()
+
+    async def produce(temp_path):
+        return await loop.run_in_executor(
+            card_pool, render_now_playing,
+            temp_path, thumbnail_path, title, duration,
+        )
+
+    return await card_store.produce(key, produce)
+
+
+async def prepare_stream_card(info, duration):
+    thumbnail_url = info.get("thumbnail", START_IMAGE_URL)
+    thumbnail = await thumbnail_store.fetch(info.get("id"), thumbnail_url)
+    if not thumbnail:
+        return None
+    card = await render_stream_card(
+        info.get("id"), thumbnail, info.get("title"), duration
+    )
+    return card or thumbnail
+
+
+# Chat Queue
+
+@dataclass(slots=True)
+class QueueEntry:
+    media_stream: object
+    thumbnail: str
+    title: str
+    duration: str
+    stream_type: str
+    chat_link: str
+    mention: str
+    link: str = None
+    seconds: int = 0
+    stream_url: str = None
+    resolved_at: float = 0.0
+    started_at: float = None
+    validated_at: float = 0.0
+
+
+class ChatQueue:
+    """Index 0 is the track now playing, the rest are upcoming"""
+    __slots__ = ("entries", "maxlen")
+
+    def __init__(self, maxlen):
+        self.entries = deque()
+        self.maxlen = maxlen
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    @property
+    def current(self):
+        return self.entries[0] if self.entries else None
+
+    @property
+    def full(self):
+        return len(self.entries) >= self.maxlen
+
+    def append(self, entry):
+        if self.full:
+            return None
+        self.entries.append(entry)
+        return len(self.entries) - 1
+
+    def popleft(self):
+        return self.entries.popleft() if self.entries else None
+
+    def upcoming(self, limit=None):
+        stop = None if limit is None else 1 + limit
+        return list(islice(self.entries, 1, stop))
+
+    def page(self, number, per_page):
+        start = (number - 1) * per_page
+        return list(enumerate(islice(self.entries, start, start + per_page), start))
+
+    def remove_at(self, pos):
+        if not 1 <= pos < len(self.entries):
+            return None
+        entry = self.entries[pos]
+        del self.entries[pos]
+        return entry
+
+    def move(self, src, dst):
+        if not (1 <= src < len(self.entries) and 1 <= dst < len(self.entries)):
+            return False
+        entry = self.entries[src]
+        del self.entries[src]
+        self.entries.insert(dst, entry)
+        return True
+
+    def shuffle(self):
+        upcoming = self.upcoming()
+        random.shuffle(upcoming)
+        current = self.entries[0]
+        self.entries = deque([current, *upcoming])
+        return len(upcoming)
+
+    def clear_upcoming(self):
+        removed = len(self.entries) - 1
+        while len(self.entries) > 1:
+            self.entries.pop()
+        return max(removed, 0)
+
+
+# Chat Sessions
+
+@dataclass(slots=True)
+class ChatSession:
+    chat_id: int
+    queue: ChatQueue
+    stream_type: str = None
+    paused: bool = False
+    invite_link: str = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    gaps: LatencyStats = field(default_factory=lambda: LatencyStats(maxlen=50))
+
+
+class SessionRegistry:
+    """All per-chat stream state, with O(1) indexes by stream type"""
+
+    def __init__(self):
+        self.sessions = {}
+        self.audio = set()
+        self.video = set()
+        self.active = set()
+        self.dirty = set()
+
+    def __contains__(self, chat_id):
+        return chat_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, chat_id):
+        return self.sessions.get(chat_id)
+
+    def items(self):
+        return list(self.sessions.items())
+
+    def values(self):
+        return list(self.sessions.values())
+
+    def ensure(self, chat_id):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            session = self.sessions[chat_id] = ChatSession(
+                chat_id, ChatQueue(QUEUE_MAX_LENGTH)
+            )
+        self.dirty.add(chat_id)
+        return session
+
+    def mark(self, chat_id):
+        session = self.sessions.get(chat_id)
+        if session is not None:
+            session.updated_at = time.time()
+        self.dirty.add(chat_id)
+
+    def set_stream_type(self, chat_id, stream_type):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            return
+        self.audio.discard(chat_id)
+        self.video.discard(chat_id)
+        if stream_type == "Audio":
+            self.audio.add(chat_id)
+        elif stream_type == "Video":
+            self.video.add(chat_id)
+        self.active.add(chat_id)
+        session.stream_type = stream_type
+        self.mark(chat_id)
+
+    def set_paused(self, chat_id, paused):
+        session = self.sessions.get(chat_id)
+        if session is not None:
+            session.paused = paused
+            self.mark(chat_id)
+
+    def close(self, chat_id):
+        # No awaits in here, so teardown can never be observed half-done
+        self.audio.discard(chat_id)
+        self.video.discard(chat_id)
+        self.active.discard(chat_id)
+        self.dirty.add(chat_id)
+        return self.sessions.pop(chat_id, None)
+
+
+sessions = SessionRegistry()
+
+
+def get_queue(chat_id):
+    session = sessions.get(chat_id)
+    return session.queue if session else None
+
+
+async def put_queue(
+    chat_id,
+    media_stream,
+    thumbnail,
+    title,
+    duration,
+    stream_type,
+    chat_link,
+    mention,
+    link=None,
+    seconds=None,
+    stream_url=None,
+):
+    try:
+        seconds = int(seconds or 0)
+    except (ValueError, TypeError):
+        seconds = 0
+    put = QueueEntry(
+        media_stream=media_stream,
+        thumbnail=thumbnail,
+        title=title,
+        duration=duration,
+        stream_type=stream_type,
+        chat_link=chat_link,
+        mention=mention,
+        link=link,
+        seconds=seconds,
+        stream_url=stream_url,
+        resolved_at=time.time(),
+    )
+    session = sessions.ensure(chat_id)
+    if chat_link and chat_link != session.invite_link:
+        session.invite_link = chat_link
+    sessions.mark(chat_id)
+    
+    return session.queue.append(put)
+
+
+
+def build_media_stream(stream_url, stream_type):
+    if CALL_WORKERS and multiprocessing.parent_process() is None:
+        # The worker that owns the call builds the real MediaStream
+        return {"stream_url": stream_url, "stream_type": stream_type}
+    if stream_type != "Video":
+        return MediaStream(
+            media_path=stream_url,
+            video_flags=MediaStream.Flags.IGNORE,
+            audio_parameters=AudioQuality.STUDIO,
+        )
+    return MediaStream(
+        media_path=stream_url,
+        audio_parameters=AudioQuality.STUDIO,
+        video_parameters=VideoQuality.HD_720p,
+    )
+
+
+# Call Workers
+
+# Errors the frontend branches on, rebuilt by name since not all of them pickle
+REMOTE_ERRORS = {
+    error.__name__: error
+    for error in (
+        NoActiveGroupCall,
+        TelegramServerError,
+        ChatAdminRequired,
+        FloodWait,
+        InviteHashExpired,
+        InviteHashInvalid,
+        InviteRequestSent,
+        UserAlreadyParticipant,
+        UserNotParticipant,
+    )
+}
+
+
+def dump_error(e):
+    return type(e).__name__, str(e), getattr(e, "value", None)
+
+
+def load_error(payload):
+    name, text, value = payload
+    error = REMOTE_ERRORS.get(name)
+    if error is not None:
+        # RPC errors take their value, NoActiveGroupCall takes nothing at all
+        for args in ((value,), (text,), ()):
+            try:
+                return error(*args)
+            except Exception:
+                continue
+    return RuntimeError(f"{name}: {text}")
+
+
+class CallWorker:
+    """One userbot and its PyTgCalls running in a child process"""
+
+    def __init__(self, index, session):
+        self.index = index
+        self.session = session
+        self.assistant = None
+        self.process = None
+        self.conn = None
+        self.me = None
+        self.ready = None
+        self.pending = {}
+        self.sequence = 0
+        self.restarts = 0
+        self.cpu = 0.0
+        self.cpu_percent = 0.0
+        self.rss = 0
+        self.checked_at = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context("spawn")
+        self.conn, child = context.Pipe()
+        self.ready = loop.create_future()
+        self.process = context.Process(
+            target=call_worker_main,
+            args=(self.index, self.session, child),
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        loop.add_reader(self.conn.fileno(), self.on_readable)
+
+    def stop(self):
+        if self.conn:
+            try:
+                asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            except Exception:
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"worker {self.index} stopped"))
+        self.pending = {}
+
+    def alive(self):
+        return bool(self.process and self.process.is_alive() and self.conn)
+
+    def on_readable(self):
+        try:
+            while self.conn and self.conn.poll():
+                self.dispatch(self.conn.recv())
+        except (EOFError, OSError):
+            self.stop()
+
+    def dispatch(self, message):
+        kind = message[0]
+        if kind == "ready":
+            self.me = SimpleNamespace(**message[1])
+            if not self.ready.done():
+                self.ready.set_result(True)
+        elif kind == "failed":
+            if not self.ready.done():
+                self.ready.set_exception(RuntimeError(message[1]))
+        elif kind == "result":
+            _, seq, ok, value = message
+            future = self.pending.pop(seq, None)
+            if future and not future.done():
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(load_error(value))
+        elif kind == "event":
+            _, event, chat_id = message
+            # Ignore late events for chats that already moved elsewhere
+            if assistants.placed(chat_id) is not self.assistant:
+                return
+            if event == "stream_end":
+                fire_and_forget(change_stream(chat_id, time.perf_counter()))
+            else:
+                fire_and_forget(close_stream(chat_id))
+
+    async def request(self, target, method, *args, **kwargs):
+        if not self.alive():
+            raise ConnectionError(f"worker {self.index} is not running")
+        self.sequence += 1
+        seq = self.sequence
+        future = asyncio.get_running_loop().create_future()
+        self.pending[seq] = future
+        self.conn.send((target, seq, method, args, kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout=CALL_WORKER_TIMEOUT)
+        finally:
+            # self.sequence may already belong to a newer, overlapping request
+            self.pending.pop(seq, None)
+
+    async def ping(self):
+        stats = await self.request("worker", "stats")
+        now = time.monotonic()
+        if self.checked_at:
+            self.cpu_percent = (stats["cpu"] - self.cpu) / (now - self.checked_at) * 100
+        self.cpu, self.rss, self.checked_at = stats["cpu"], stats["rss"], now
+        return self.me
+
+    def stats(self):
+        return {
+            "pid": self.process.pid if self.process else None,
+            "alive": self.alive(),
+            "cpu": self.cpu_percent,
+            "rss": self.rss,
+            "restarts": self.restarts,
+        }
+
+
+class RemoteClient:
+    """The parts of the userbot Client the frontend uses, proxied to a worker"""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    @property
+    def me(self):
+        return self.worker.me
+
+    @property
+    def is_connected(self):
+        return self.worker.alive()
+
+    async def start(self):
+        self.worker.start()
+        await asyncio.wait_for(self.worker.ready, timeout=CALL_WORKER_TIMEOUT * 2)
+
+    async def get_me(self):
+        return await self.worker.ping()
+
+    async def join_chat(self, chat_id):
+        return await self.worker.request("client", "join_chat", chat_id)
+
+    async def resolve_peer(self, peer_id):
+        return await self.worker.request("client", "resolve_peer", peer_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.worker.request("client", "send_message", chat_id, text, **kwargs)
+
+
+class RemoteCall:
+    def __init__(self, worker):
+        self.worker = worker
+
+    async def start(self):
+        pass
+
+    def on_update(self, filters=None):
+        # Worker events are routed by CallWorker.dispatch
+        return lambda func: func
+
+    async def play(self, chat_id, stream=None, config=None):
+        return await self.worker.request("call", "play", chat_id, stream)
+
+    async def pause(self, chat_id):
+        return await self.worker.request("call", "pause", chat_id)
+
+    async def resume(self, chat_id):
+        return await self.worker.request("call", "resume", chat_id)
+
+    async def leave_call(self, chat_id):
+        return await self.worker.request("call", "leave_call", chat_id)
+
+
+def call_worker_main(index, session, conn):
+    asyncio.run(serve_call_worker(index, session, conn))
+
+
+async def serve_call_worker(index, session, conn):
+    client = Client(
+        f"Worker{index}", api_id=API_ID, api_hash=API_HASH,
+        session_string=session, in_memory=True,
+    )
+    worker_call = PyTgCalls(client)
+
+    @worker_call.on_update(fl.stream_end())
+    async def on_stream_end(_, update: Update):
+        conn.send(("event", "stream_end", update.chat_id))
+
+    async def on_closed(_, update: Update):
+        conn.send(("event", "closed", update.chat_id))
+
+    for status in (
+        ChatUpdate.Status.CLOSED_VOICE_CHAT,
+        ChatUpdate.Status.KICKED,
+        ChatUpdate.Status.LEFT_GROUP,
+    ):
+        worker_call.on_update(fl.chat_update(status))(on_closed)
+
+    try:
+        await client.start()
+        await worker_call.start()
+    except Exception as e:
+        conn.send(("failed", str(e)))
+        return
+    conn.send(("ready", {"id": client.me.id, "username": client.me.username}))
+
+    async def handle(target, seq, method, args, kwargs):
+        try:
+            if target == "worker":
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                value = {"cpu": usage.ru_utime + usage.ru_stime, "rss": usage.ru_maxrss * 1024}
+            elif target == "call" and method == "play":
+                chat_id, stream = args
+                media_stream = build_media_stream(stream["stream_url"], stream["stream_type"])
+                await worker_call.play(chat_id, media_stream, config=call_config)
+                value = None
+            elif target == "call":
+                await getattr(worker_call, method)(*args)
+                value = None
+            else:
+                # Pyrogram objects hold the client, only the outcome goes back
+                await getattr(client, method)(*args, **kwargs)
+                value = None
+            conn.send(("result", seq, True, value))
+        except Exception as e:
+            conn.send(("result", seq, False, dump_error(e)))
+
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+    tasks = set()
+
+    def on_readable():
+        try:
+            while conn.poll():
+                task = loop.create_task(handle(*conn.recv()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (EOFError, OSError):
+            loop.remove_reader(conn.fileno())
+            if not closed.done():
+                closed.set_result(None)
+
+    loop.add_reader(conn.fileno(), on_readable)
+    await closed
+
+
+call_workers = []
+
+
+async def restart_call_worker(assistant):
+    worker = assistant.client.worker
+    logs.error(f"Call worker {worker.index} died, restarting")
+    assistant.healthy = False
+    orphaned = set(assistant.chats)
+    worker.stop()
+    if orphaned and len(assistants.healthy()):
+        await assistants.failover(assistant)
+    worker.restarts += 1
+    try:
+        await assistant.client.start()
+    except Exception as e:
+        logs.error(f"Call worker {worker.index} failed to restart: {e}")
+        worker.stop()
+        return
+    assistant.healthy = True
+    assistant.failures = 0
+    # With no other assistant up, the chats come back to the new process
+    if assistant.chats:
+        await assistants.failover(assistant)
+
+
+async def run_call_supervisor():
+    while True:
+        await asyncio.sleep(CALL_WORKER_CHECK_INTERVAL)
+        for assistant in assistants.assistants:
+            if assistant.client.worker.alive():
+                continue
+            try:
+                await restart_call_worker(assistant)
+            except Exception as e:
+                logs.error(f"Call worker supervisor failed: {e}")
+
+
+def stop_call_workers():
+    for worker in call_workers:
+        worker.stop()
+
+
+async def play_stream(call, chat_id, media_stream):
+    started = time.perf_counter()
+    try:
+        return await call.play(chat_id, media_stream, config=call_config)
+    finally:
+        call_play_seconds.observe(time.perf_counter() - started)
+
+
+# Assistant Pool
+
+placementsdb = mongodb.tgplacements
+
+
+class Assistant:
+    def __init__(self, index, client, call):
+        self.index = index
+        self.client = client
+        self.call = call
+        self.healthy = False
+        self.failures = 0
+        self.chats = set()
+
+    @property
+    def user_id(self):
+        return self.client.me.id if self.client.me else None
+
+    @property
+    def name(self):
+        me = self.client.me
+        return f"@{me.username}" if me and me.username else f"#{self.index}"
+
+
+class AssistantPool:
+    """Userbots with their own PyTgCalls, chats stick to the one that joined"""
+
+    def __init__(self, assistants, collection):
+        self.assistants = assistants
+        self.collection = collection
+        # chat_id -> assistant user id, kept after the session ends so a
+        # later /play reuses the userbot that is already a member
+        self.placements = {}
+        self.failovers = 0
+
+    @property
+    def primary(self):
+        return self.assistants[0]
+
+    async def load(self):
+        try:
+            async for doc in self.collection.find({}):
+                self.placements[doc["_id"]] = doc["user_id"]
+        except Exception as e:
+            logs.error(f"Failed to load assistant placements: {e}")
+
+    async def start(self):
+        for assistant in self.assistants:
+            try:
+                await assistant.client.start()
+                await assistant.call.start()
+            except Exception as e:
+                logs.info(f"🚫 Failed to start Assistant {assistant.index}❗\n⚠️ Reason: {e}")
+                continue
+            assistant.healthy = True
+        return self.healthy()
+
+    def healthy(self):
+        return [assistant for assistant in self.assistants if assistant.healthy]
+
+    def placed(self, chat_id):
+        user_id = self.placements.get(chat_id)
+        for assistant in self.assistants:
+            if user_id and assistant.user_id == user_id:
+                return assistant
+        return None
+
+    def place(self, chat_id):
+        assistant = self.placed(chat_id)
+        if assistant and assistant.healthy:
+            return assistant
+        candidates = self.healthy() or [self.primary]
+        assistant = min(candidates, key=lambda a: (len(a.chats), a.index))
+        if assistant.user_id and self.placements.get(chat_id) != assistant.user_id:
+            self.placements[chat_id] = assistant.user_id
+            fire_and_forget(timed_mongo("placement_put", self.collection.update_one(
+                {"_id": chat_id}, {"$set": {"user_id": assistant.user_id}}, upsert=True
+            )))
+        return assistant
+
+    def call_for(self, chat_id):
+        assistant = self.placed(chat_id) or self.primary
+        return assistant.call
+
+    def attach(self, chat_id, assistant):
+        for other in self.assistants:
+            other.chats.discard(chat_id)
+        assistant.chats.add(chat_id)
+
+    def release(self, chat_id):
+        for assistant in self.assistants:
+            assistant.chats.discard(chat_id)
+
+    async def check(self, assistant):
+        try:
+            await asyncio.wait_for(
+                assistant.client.get_me(), timeout=ASSISTANT_HEALTH_TIMEOUT
+            )
+        except Exception as e:
+            assistant.failures += 1
+            if assistant.healthy and assistant.failures >= ASSISTANT_MAX_FAILURES:
+                logs.error(f"Assistant {assistant.name} is down: {e}")
+                assistant.healthy = False
+                await self.failover(assistant)
+            return
+        assistant.failures = 0
+        if not assistant.healthy and assistant.client.is_connected:
+            logs.info(f"Assistant {assistant.name} is back")
+            assistant.healthy = True
+            # Chats stranded while no assistant was up are replayed now
+            for stranded in self.assistants:
+                if stranded.chats and (stranded is assistant or not stranded.healthy):
+                    await self.failover(stranded)
+
+    async def failover(self, assistant):
+        if not self.healthy():
+            # Nowhere to move them, they stay here until an assistant recovers
+            return
+        chats, assistant.chats = assistant.chats, set()
+        for chat_id in chats:
+            session = sessions.get(chat_id)
+            current = session.queue.current if session else None
+            if current is None:
+                continue
+            if not self.healthy():
+                assistant.chats.add(chat_id)
+                continue
+            target = self.place(chat_id)
+            try:
+                await join_assistant(chat_id, target, session.invite_link)
+                if not await refresh_entry(current):
+                    raise ValueError("stream could not be re-resolved")
+                await play_stream(target.call, chat_id, current.media_stream)
+                if session.paused:
+                    await target.call.pause(chat_id)
+            except Exception as e:
+                logs.error(f"Failover of {chat_id} to {target.name} failed: {e}")
+                sessions.close(chat_id)
+                continue
+            current.started_at = time.time()
+            self.attach(chat_id, target)
+            self.failovers += 1
+
+    def stats(self):
+        return [
+            {
+                "name": assistant.name,
+                "healthy": assistant.healthy,
+                "chats": len(assistant.chats),
+            }
+            for assistant in self.assistants
+        ]
+
+
+if CALL_WORKERS:
+    call_workers = [
+        CallWorker(index, session)
+        for index, session in enumerate([STRING_SESSION] + EXTRA_STRING_SESSIONS)
+    ]
+    assistants = AssistantPool(
+        [
+            Assistant(worker.index, RemoteClient(worker), RemoteCall(worker))
+            for worker in call_workers
+        ],
+        placementsdb,
+    )
+    for member in assistants.assistants:
+        member.client.worker.assistant = member
+else:
+    assistants = AssistantPool(
+        [Assistant(0, app, call)]
+        + [
+            Assistant(index, client, PyTgCalls(client))
+            for index, client in enumerate(extra_apps, start=1)
+        ],
+        placementsdb,
+    )
+
+
+async def join_assistant(chat_id, assistant, invitelink=None):
+    if not invitelink:
+        invitelink = await invite_links.get(bot, chat_id)
+    try:
+        try:
+            await assistant.client.join_chat(invitelink)
+        except (InviteHashExpired, InviteHashInvalid):
+            invitelink = await invite_links.get(bot, chat_id, refresh=True)
+            await assistant.client.join_chat(invitelink)
+    except InviteRequestSent:
+        await bot.approve_chat_join_request(chat_id, assistant.user_id)
+    except UserAlreadyParticipant:
+        pass
+
+
+async def run_assistant_health():
+    while True:
+        await asyncio.sleep(ASSISTANT_HEALTH_INTERVAL)
+        for assistant in assistants.assistants:
+            if assistant.client.me is None:
+                continue
+            try:
+                await assistants.check(assistant)
+            except Exception as e:
+                logs.error(f"Assistant health check failed: {e}")
+
+
+# Queue Look-Ahead
+
+lookahead_stats = {
+    "validated": 0,
+    "refreshed": 0,
+    "failed": 0,
+    "hits": 0,
+    "misses": 0,
+}
+
+
+def is_entry_fresh(entry, starts_at):
+    stream_url = entry.stream_url
+    if not stream_url:
+        return False
+    expiry = stream_url_expiry(stream_url)
+    if not expiry:
+        expiry = entry.resolved_at + RESOLVER_CACHE_TTL
+    return expiry - RESOLVER_CACHE_MARGIN > starts_at
+
+
+async def probe_stream_url(stream_url):
+    try:
+        # Media hosts go through the media session, the API pool stays API-only
+        async with get_media_session().head(
+            stream_url, timeout=aiohttp.ClientTimeout(total=LOOKAHEAD_PROBE_TIMEOUT)
+        ) as response:
+            return response.status < 400
+    except Exception:
+        return False
+
+
+async def refresh_entry(entry):
+    if not entry.link:
+        return False
+    if entry.stream_url:
+        resolver_cache.invalidate_url(entry.stream_url)
+    info = await get_stream_info(entry.link, entry.stream_type)
+    if not is_usable_info(info):
+        lookahead_stats["failed"] += 1
+        return False
+    entry.stream_url = info["stream_url"]
+    entry.media_stream = build_media_stream(info["stream_url"], entry.stream_type)
+    entry.resolved_at = time.time()
+    lookahead_stats["refreshed"] += 1
+    return True
+
+
+async def refresh_upcoming(queued):
+    now = time.time()
+    current = queued.current
+    # Without a known duration (live streams) the next start time is unknown
+    if not current.seconds or not current.started_at:
+        return
+    starts_at = current.started_at + current.seconds
+    for entry in queued.upcoming(LOOKAHEAD_ENTRIES):
+        if starts_at - now > LOOKAHEAD_WINDOW:
+            break
+        if entry.validated_at < now - LOOKAHEAD_WINDOW:
+            if is_entry_fresh(entry, starts_at) and await probe_stream_url(entry.stream_url):
+                lookahead_stats["validated"] += 1
+                entry.validated_at = now
+            elif await refresh_entry(entry):
+                entry.validated_at = now
+        if not entry.seconds:
+            break
+        starts_at += entry.seconds
+
+
+async def run_queue_lookahead():
+    while True:
+        await asyncio.sleep(LOOKAHEAD_INTERVAL)
+        for chat_id, session in sessions.items():
+            if not session.queue:
+                continue
+            try:
+                await refresh_upcoming(session.queue)
+            except Exception as e:
+                logs.error(f"Look-ahead failed for {chat_id}: {e}")
+
+
+async def close_stream(chat_id):
+    sessions.close(chat_id)
+    assistants.release(chat_id)
+    try:
+        await assistants.call_for(chat_id).leave_call(chat_id)
+    except Exception:
+        pass
+
+
+# Invite Links
+
+invitesdb = mongodb.tginvites
+
+
+class InviteLinkCache:
+    def __init__(self, collection, ttl):
+        self.collection = collection
+        self.ttl = ttl
+        self.links = {}
+        self.flight = SingleFlight()
+        self.created = 0
+
+    async def load(self):
+        try:
+            # Mongo drops expired links on its own
+            await self.collection.create_index(
+                "created_at", expireAfterSeconds=int(self.ttl)
+            )
+        except Exception as e:
+            logs.info(f"⚠️ Invite link TTL index not created: {e}")
+        async for doc in self.collection.find({}):
+            self.remember(doc["_id"], doc["link"], doc["created_at"])
+
+    def remember(self, chat_id, link, created_at):
+        created = created_at.replace(tzinfo=timezone.utc).timestamp()
+        if created + self.ttl > time.time():
+            self.links[chat_id] = (link, created + self.ttl)
+
+    def cached(self, chat_id):
+        entry = self.links.get(chat_id)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    async def get(self, client, chat_id, refresh=False):
+        if not refresh:
+            link = self.cached(chat_id)
+            if link:
+                return link
+        return await self.flight.do(chat_id, self.fetch, client, chat_id, refresh)
+
+    async def fetch(self, client, chat_id, refresh):
+        if not refresh:
+            doc = await timed_mongo("invite_get", self.collection.find_one({"_id": chat_id}))
+            if doc:
+                self.remember(chat_id, doc["link"], doc["created_at"])
+                link = self.cached(chat_id)
+                if link:
+                    return link
+        # An additional link, so the chat's primary link is never revoked.
+        # It expires shortly after the cache forgets it, so none pile up
+        created_at = datetime.now(timezone.utc)
+        invite = await client.create_chat_invite_link(
+            chat_id,
+            expire_date=created_at + timedelta(seconds=self.ttl + INVITE_LINK_MARGIN),
+        )
+        self.created += 1
+        self.remember(chat_id, invite.invite_link, created_at)
+        await timed_mongo("invite_put", self.collection.replace_one(
+            {"_id": chat_id},
+            {"link": invite.invite_link, "created_at": created_at},
+            upsert=True,
+        ))
+        return invite.invite_link
+
+
+invite_links = InviteLinkCache(invitesdb, INVITE_LINK_TTL)
+
+
+# Warm Restart
+
+sessionsdb = mongodb.tgsessions
+restore_stats = {"chats": 0, "restored": 0, "failed": 0, "seconds": 0.0}
+
+
+def snapshot_session(session):
+    return {
+        "stream_type": session.stream_type,
+        "paused": session.paused,
+        "invite_link": session.invite_link,
+        "updated_at": session.updated_at,
+        "entries": [
+            {
+                "title": entry.title,
+                "duration": entry.duration,
+                "stream_type": entry.stream_type,
+                "chat_link": entry.chat_link,
+                "mention": entry.mention,
+                "link": entry.link,
+                "seconds": entry.seconds,
+                "thumbnail": entry.thumbnail,
+            }
+            for entry in session.queue
+        ],
+    }
+
+
+async def save_session_snapshots():
+    if not sessions.dirty:
+        return
+    dirty, sessions.dirty = sessions.dirty, set()
+    requests = []
+    for chat_id in dirty:
+        session = sessions.get(chat_id)
+        if session and session.queue:
+            requests.append(ReplaceOne(
+                {"_id": chat_id}, snapshot_session(session), upsert=True
+            ))
+        else:
+            requests.append(DeleteOne({"_id": chat_id}))
+    try:
+        await asyncio.wait_for(
+            timed_mongo("session_snapshot", sessionsdb.bulk_write(requests, ordered=False)),
+            timeout=REGISTRY_FLUSH_TIMEOUT,
+        )
+    except Exception as e:
+        sessions.dirty |= dirty
+        logs.error(f"Failed to snapshot sessions: {e}")
+
+
+async def run_session_snapshots():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        await save_session_snapshots()
+
+
+async def restore_session(doc, semaphore):
+    chat_id = doc["_id"]
+    async with semaphore:
+        entries = [
+            QueueEntry(media_stream=None, **item) for item in doc.get("entries", [])
+        ]
+        if not entries or not await refresh_entry(entries[0]):
+            return False
+        session = sessions.ensure(chat_id)
+        session.invite_link = doc.get("invite_link")
+        for entry in entries:
+            session.queue.append(entry)
+        current = session.queue.current
+        assistant = assistants.place(chat_id)
+        try:
+            await play_stream(assistant.call, chat_id, current.media_stream)
+        except Exception as e:
+            logs.info(f"Could not restore stream in {chat_id}: {e}")
+            sessions.close(chat_id)
+            return False
+        assistants.attach(chat_id, assistant)
+        current.started_at = time.time()
+        await add_active_media_chat(chat_id, current.stream_type)
+        if doc.get("paused"):
+            try:
+                await assistant.call.pause(chat_id)
+                await stream_off(chat_id)
+            except Exception:
+                pass
+        return True
+
+
+async def restore_sessions():
+    started = time.perf_counter()
+    docs = []
+    async for doc in sessionsdb.find({}):
+        docs.append(doc)
+    if not docs:
+        return
+    # Only the current track is resolved now, the look-ahead handles the rest
+    semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
+    results = await asyncio.gather(
+        *(restore_session(doc, semaphore) for doc in docs),
+        return_exceptions=True,
+    )
+    restored = sum(1 for result in results if result is True)
+    for doc, result in zip(docs, results):
+        if result is not True:
+            sessions.dirty.add(doc["_id"])
+    restore_stats.update(
+        chats=len(docs),
+        restored=restored,
+        failed=len(docs) - restored,
+        seconds=time.perf_counter() - started,
+    )
+    logs.info(
+        f"🔁 Restored {restored}/{len(docs)} streams in {restore_stats['seconds']:.1f}s"
+    )
+
+
+
+
+# Log Reporter
+
+log_events = deque()
+log_stats = {"queued": 0, "sent": 0, "merged": 0, "dropped": 0, "digests": 0}
+
 
+async def log_stream_info(chat_id, title, duration, stream_type, chat_link, mention, thumbnail, pos):
+    if LOG_GROUP_ID != 0 and chat_id != LOG_GROUP_ID:
+        if len(log_events) >= LOG_QUEUE_SIZE:
+            log_stats["dropped"] += 1
+            if LOG_DROP_POLICY == "newest":
+                return
+            log_events.popleft()
+        log_events.append(
+            (chat_id, title, duration, stream_type, chat_link, mention, thumbnail, pos)
+        )
+        log_stats["queued"] += 1
 
 
-async def clear_queue(chat_id):
-    check = queues.get(chat_id)
-    if check:
-        queues.pop(chat_id)
+# chat_id -> retry time, for chats where the bot cannot create invite links
+log_link_failures = {}
 
 
-async def close_stream(chat_id):
+async def resolve_log_link(chat_id, chat_link):
+    if chat_link:
+        return chat_link
+    fallback = f"https://t.me/{bot.me.username}"
+    if log_link_failures.get(chat_id, 0) > time.time():
+        return fallback
     try:
-        await call.leave_call(chat_id)
+        link = await invite_links.get(bot, chat_id)
     except Exception:
-        pass
-    await clear_queue(chat_id)
-    await remove_active_media_chat(chat_id)
-
-
+        if len(log_link_failures) > 5000:
+            log_link_failures.clear()
+        log_link_failures[chat_id] = time.time() + LOG_LINK_RETRY
+        return fallback
+    log_link_failures.pop(chat_id, None)
+    return link
 
 
-async def log_stream_info(chat_id, title, duration, stream_type, chat_link, mention, thumbnail, pos):
-    if LOG_GROUP_ID != 0 and chat_id != LOG_GROUP_ID:
-        buttons = InlineKeyboardMarkup(
+async def send_log_event(chat_id, title, duration, stream_type, chat_link, mention, thumbnail, pos):
+    chat_link = await resolve_log_link(chat_id, chat_link)
+    buttons = InlineKeyboardMarkup(
+        [
             [
-                [
-                    InlineKeyboardButton(
-                        text="📡 Join Chat 💬", url=chat_link
-                    )
-                ],
-            ]
-        )
-        if pos != 0:
-            caption = f"""
+                InlineKeyboardButton(
+                    text="📡 Join Chat 💬", url=chat_link
+                )
+            ],
+        ]
+    )
+    if pos != 0:
+        caption = f"""
 **✅ Added To Queue At: #{pos}**
 
 **❍ Title:** {title}
@@ -611,47 +3090,126 @@ async def log_stream_info(chat_id, title, duration, stream_type, chat_link, ment
 **❍ Stream Type:** {stream_type}
 **❍ Requested By:** {mention}"""
 
-        else:
-            caption = f"""
+    else:
+        caption = f"""
 **✅ Started Streaming On VC.**
 
 **❍ Title:** {title}
 **❍ Duration:** {duration}
 **❍ Stream Type:** {stream_type}
 **❍ Requested By:** {mention}"""
-        
+    
+    await send_cached_photo(
+        bot, LOG_GROUP_ID, thumbnail, priority=PRIORITY_LOG, caption=caption, reply_markup=buttons
+    )
+
+
+async def send_log_digest(batch):
+    if len(batch) == 1:
+        return await send_log_event(*batch[0])
+    lines = []
+    for chat_id, title, duration, stream_type, chat_link, mention, _, pos in batch:
+        chat_link = await resolve_log_link(chat_id, chat_link)
+        status = f"Queued #{pos}" if pos != 0 else "Started"
+        lines.append(
+            f"**❍ {status}:** {title} • `{duration}` • {stream_type}\n"
+            f"    __by__ {mention} • [Join Chat]({chat_link})"
+        )
+    text = "\n".join(lines)
+    await outbound(
+        PRIORITY_LOG,
+        LOG_GROUP_ID,
+        bot.send_message,
+        LOG_GROUP_ID,
+        f"**📋 {len(batch)} Stream Events**\n\n{text}",
+        disable_web_page_preview=True,
+    )
+
+
+async def flush_log_events():
+    while log_events:
+        batch = [log_events.popleft() for _ in range(min(LOG_DIGEST_SIZE, len(log_events)))]
         try:
-            await bot.send_photo(LOG_GROUP_ID, photo=thumbnail, caption=caption, reply_markup=buttons)
-        except Exception:
-            pass
+            await send_log_digest(batch)
+        except FloodWait as e:
+            # Put the batch back in order and try again next round
+            log_events.extendleft(reversed(batch))
+            await asyncio.sleep(e.value)
+            return
+        except Exception as e:
+            log_stats["dropped"] += len(batch)
+            logs.error(f"Failed to send log digest: {e}")
+            continue
+        log_stats["digests"] += 1
+        log_stats["sent"] += len(batch)
+        log_stats["merged"] += len(batch) - 1
+
+
+async def run_log_reporter():
+    while True:
+        await asyncio.sleep(LOG_DIGEST_INTERVAL)
+        await flush_log_events()
+
+
+async def finish_stream_card(
+    reply, thumb_task, entry, caption, buttons, needs_edit,
+    chat_id, title, duration, stream_type, chat_link, mention, pos, trace,
+):
+    try:
+        with trace.span("card_wait"):
+            thumbnail = await thumb_task or START_IMAGE_URL
+    except Exception:
+        thumbnail = START_IMAGE_URL
+    entry.thumbnail = thumbnail
+    if needs_edit and reply and thumbnail != START_IMAGE_URL:
+        try:
+            with trace.span("card_edit"):
+                edited = await outbound(
+                    PRIORITY_NOTICE,
+                    chat_id,
+                    reply.edit_media,
+                    InputMediaPhoto(thumbnail, caption=caption, has_spoiler=True),
+                    reply_markup=buttons,
+                    edit_of=reply,
+                )
+            if edited and edited.photo:
+                photo_ids.put(photo_ids.source_key(thumbnail), edited.photo.file_id)
+        except Exception as e:
+            logs.error(f"Error attaching thumbnail: {str(e)}")
+    await log_stream_info(chat_id, title, duration, stream_type, chat_link, mention, thumbnail, pos)
+    play_traces.finish(trace)
 
 
+# Track Transitions
 
+transition_gaps = LatencyStats()
 
 
-async def change_stream(chat_id):
-    queued = queues.get(chat_id)
-    if queued:
-        queued.pop(0)
-        
-    if not queued:
-        await bot.send_message(chat_id, "**❎ Queue is empty, So left\nfrom VC❗...**")
-        return await close_stream(chat_id)
+def record_transition_gap(chat_id, seconds):
+    transition_gaps.record(seconds)
+    track_gap_seconds.observe(seconds)
+    session = sessions.get(chat_id)
+    if session is not None:
+        session.gaps.record(seconds)
 
-    aux = await bot.send_message(
-        chat_id, "**🔁 Processing ✨...**"
-    )
-    pos  = 0
-    media_stream = queued[0].get("media_stream")
 
-    await call.play(chat_id, media_stream, config=call_config)
-    
-    thumbnail = queued[0].get("thumbnail")
-    title = queued[0].get("title")
-    duration = queued[0].get("duration")
-    stream_type = queued[0].get("stream_type")
-    chat_link = queued[0].get("chat_link")
-    mention = queued[0].get("mention")
+async def notify_queue_empty(chat_id):
+    try:
+        await outbound(
+            PRIORITY_NOTICE, chat_id, bot.send_message, chat_id, "**❎ Queue is empty, So left\nfrom VC❗...**"
+        )
+    except Exception:
+        pass
+
+
+async def announce_stream(chat_id, entry):
+    pos  = 0
+    thumbnail = entry.thumbnail
+    title = entry.title
+    duration = entry.duration
+    stream_type = entry.stream_type
+    chat_link = entry.chat_link
+    mention = entry.mention
     buttons = InlineKeyboardMarkup(
         [
             [
@@ -668,21 +3226,62 @@ async def change_stream(chat_id):
 **❍ Duration:** {duration}
 **❍ Stream Type:** {stream_type}
 **❍ Requested By:** {mention}"""
-    try:
-        await aux.delete()
-    except Exception:
-        pass
-    await add_active_media_chat(chat_id, stream_type)
     try:
         # Try sending photo from the path rather than direct URL
-        await bot.send_photo(chat_id, photo=thumbnail, caption=caption, has_spoiler=True, reply_markup=buttons)
+        await send_cached_photo(bot, chat_id, thumbnail, priority=PRIORITY_NOTICE, caption=caption, has_spoiler=True, reply_markup=buttons)
     except Exception as e:
         # Fall back to a default image if there's an issue with the thumbnail
-        await bot.send_photo(chat_id, photo=START_IMAGE_URL, caption=caption, has_spoiler=True, reply_markup=buttons)
+        try:
+            await send_cached_photo(bot, chat_id, START_IMAGE_URL, priority=PRIORITY_NOTICE, caption=caption, has_spoiler=True, reply_markup=buttons)
+        except Exception:
+            pass
         logs.error(f"Error sending photo in change_stream: {str(e)}")
     await log_stream_info(chat_id, title, duration, stream_type, chat_link, mention, thumbnail, pos)
 
 
+async def change_stream(chat_id, ended_at=None):
+    # The gap is measured from the end of the previous track (or the /skip)
+    ended_at = ended_at or time.perf_counter()
+    queued = get_queue(chat_id)
+    if queued:
+        queued.popleft()
+        sessions.mark(chat_id)
+        
+    while True:
+        if not queued:
+            fire_and_forget(notify_queue_empty(chat_id))
+            return await close_stream(chat_id)
+
+        entry = queued.current
+        # Start from a fresh URL even if the look-ahead did not get to it
+        if entry.media_stream is not None and is_entry_fresh(entry, time.time()):
+            lookahead_stats["hits"] += 1
+            break
+        lookahead_stats["misses"] += 1
+        refreshed = await refresh_entry(entry)
+        # /end, /skip or /clear may have run while the entry was re-resolved
+        if get_queue(chat_id) is not queued or queued.current is not entry:
+            return
+        if refreshed:
+            break
+        logs.info(f"Skipping unplayable track in {chat_id}: {entry.title}")
+        queued.popleft()
+        sessions.mark(chat_id)
+
+    try:
+        await play_stream(assistants.call_for(chat_id), chat_id, entry.media_stream)
+    except Exception:
+        if entry.stream_url:
+            resolver_cache.invalidate_url(entry.stream_url)
+        raise
+    record_transition_gap(chat_id, time.perf_counter() - ended_at)
+    entry.started_at = time.time()
+    play_rate.hit()
+    await add_active_media_chat(chat_id, entry.stream_type)
+    # Chat and log messages never hold up the next track
+    fire_and_forget(announce_stream(chat_id, entry))
+
+
 @bot.on_message(filters.command("start") & filters.private)
 async def start_welcome_private(client, message):
     chat_id = message.chat.id
@@ -711,8 +3310,8 @@ powerƒul vc music player bot.
         ]
     )
     try:
-        return await client.send_photo(
-            chat_id, photo=photo, caption=caption, has_spoiler=True, reply_markup=buttons
+        return await send_cached_photo(
+            client, chat_id, photo, caption=caption, has_spoiler=True, reply_markup=buttons
         )
     except Exception:
         pass
@@ -732,6 +3331,11 @@ Their Uses.
 /resume - resume paused stream.
 /skip - skip to next stream.
 /end - stop stream & clear queue.
+/queue - show queued streams.
+/remove - remove a queued stream.
+/move - move a queued stream.
+/shuffle - shuffle queued streams.
+/clear - clear queued streams.
 
 Example:
 • /play sidhu moosewala
@@ -751,8 +3355,8 @@ Example:
         ]
     )
     try:
-        await bot.send_photo(
-            chat_id, photo=photo, caption=caption, has_spoiler=True, reply_markup=buttons
+        await send_cached_photo(
+            bot, chat_id, photo, caption=caption, has_spoiler=True, reply_markup=buttons
         )
     except Exception:
         pass
@@ -762,31 +3366,20 @@ Example:
 
 @bot.on_message(filters.command(["play", "vplay"]) & ~filters.private)
 async def start_audio_stream(client, message):
+    started = time.perf_counter()
+    trace = PlayTrace(message.chat.id)
+    handed_off = False
     try:
-        await message.delete()
+        with trace.span("delete_command"):
+            await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.delete)
     except Exception:
         pass
     chat_id = message.chat.id
     if message.chat.username:
         chat_link = f"https://t.me/{message.chat.username}"
     else:
-        chatlinks = clinks.get(chat_id)
-        
-        if chatlinks:
-            if chatlinks == f"https://t.me/{client.me.username}":
-                try:
-                    chat_link = await client.export_chat_invite_link(chat_id)
-                except Exception:
-                    chat_link = chatlinks
-            else:
-                chat_link = chatlinks
-        else:
-            try:
-                chat_link = await client.export_chat_invite_link(chat_id)
-            except Exception:
-                chat_link = f"https://t.me/{client.me.username}"
-            
-    clinks[chat_id] = chat_link
+        # Only a cached link here, exporting is left to whoever needs it
+        chat_link = invite_links.cached(chat_id)
     
     try:
         mention = message.from_user.mention
@@ -800,8 +3393,8 @@ async def start_audio_stream(client, message):
         
     try:
         if len(message.command) < 2:
-            return await client.send_message(
-                chat_id, f"""
+            return await outbound(
+                PRIORITY_INTERACTIVE, chat_id, client.send_message, chat_id, f"""
 **🥀 Give Me Some Query To
 Stream Audio Or Video❗...
 
@@ -809,12 +3402,17 @@ Stream Audio Or Video❗...
 ≽ Audio: `/play yalgaar`
 ≽ Video: `/vplay yalgaar`**"""
             )
-        aux = await client.send_message(chat_id, "**🔁 Processing ✨...**")
+        with trace.span("processing_reply"):
+            aux = await outbound(
+                PRIORITY_INTERACTIVE, chat_id, client.send_message, chat_id, "**🔁 Processing ✨...**"
+            )
         query = message.text.split(None, 1)[1]
+        trace.query = query
         streamtype = "Audio" if not message.command[0].startswith("v") else "Video"
-        info = await get_stream_info(query, streamtype)
+        with trace.span("resolve"):
+            info = await get_stream_info(query, streamtype)
         if not info:
-            return await aux.edit("**❌ Failed to fetch details, try\nanother song or search term.**")
+            return await outbound(PRIORITY_INTERACTIVE, chat_id, aux.edit_text, "**❌ Failed to fetch details, try\nanother song or search term.**")
             
         link = info.get("link")
         title = f"[{info.get('title')[:18]}]({link})"
@@ -828,17 +3426,9 @@ Stream Audio Or Video❗...
         stream_type = info.get("stream_type")
         
         if not stream_url:
-            return await aux.edit("**❌ No stream URL found. Please try a different search term.**")
+            return await outbound(PRIORITY_INTERACTIVE, chat_id, aux.edit_text, "**❌ No stream URL found. Please try a different search term.**")
         
-        media_stream = MediaStream(
-            media_path=stream_url,
-            video_flags=MediaStream.Flags.IGNORE,
-            audio_parameters=AudioQuality.STUDIO,
-        ) if stream_type != "Video" else MediaStream(
-            media_path=stream_url,
-            audio_parameters=AudioQuality.STUDIO,
-            video_parameters=VideoQuality.HD_720p,
-        )
+        media_stream = build_media_stream(stream_url, stream_type)
         
         buttons = InlineKeyboardMarkup(
             [
@@ -850,17 +3440,25 @@ Stream Audio Or Video❗...
             ]
         )
         
-        queued = queues.get(chat_id)
+        queued = get_queue(chat_id)
+        if queued and queued.full:
+            return await outbound(PRIORITY_INTERACTIVE, chat_id, aux.edit_text, f"**❌ Queue is full, max {QUEUE_MAX_LENGTH} tracks❗...**")
+        
+        # Build the now-playing card alongside call join and playback
+        thumb_task = asyncio.ensure_future(
+            prepare_stream_card(info, duration)
+        )
+        card_started = time.perf_counter()
+        thumb_task.add_done_callback(
+            lambda _: trace.add("card_render", time.perf_counter() - card_started)
+        )
+        
         if queued:
-            thumbnail_url = info.get("thumbnail", START_IMAGE_URL)
-            # Download the thumbnail for reliable sending
-            thumbnail_path = await fetch_and_save_image(thumbnail_url, f"cache/temp_{info.get('id', 'thumbnail')}.png")
-            if not thumbnail_path:
-                thumbnail_path = START_IMAGE_URL  # Fallback to START_IMAGE_URL if download fails
-                
             pos = await put_queue(
-                chat_id, media_stream, thumbnail_path, title, duration, stream_type, chat_link, mention
+                chat_id, media_stream, START_IMAGE_URL, title, duration, stream_type, chat_link, mention,
+                link=link, seconds=info.get("duration"), stream_url=stream_url,
             )
+            trace.outcome = "queued"
             caption = f"""
 **✅ Added To Queue At: #{pos}**
 
@@ -870,73 +3468,100 @@ Stream Audio Or Video❗...
 **❍ Requested By:** {mention}"""
         
         else:
+            assistant = assistants.place(chat_id)
+            userbot = assistant.client
             try: 
-                await call.play(chat_id, media_stream, config=call_config)
+                with trace.span("call_play"):
+                    await play_stream(assistant.call, chat_id, media_stream)
             except NoActiveGroupCall:
-                try:
-                    assistant = await client.get_chat_member(chat_id, app.me.id)
-                    if (
-                        assistant.status == ChatMemberStatus.BANNED
-                        or assistant.status == ChatMemberStatus.RESTRICTED
-                    ):
-                        return await aux.edit_text(
-                            f"**🤖 At first, unban [Assistant ID](https://t.me/{app.me.username}) to start stream❗**"
+                with trace.span("assistant_join"):
+                    try:
+                        member = await client.get_chat_member(chat_id, userbot.me.id)
+                        if (
+                            member.status == ChatMemberStatus.BANNED
+                            or member.status == ChatMemberStatus.RESTRICTED
+                        ):
+                            return await outbound(
+                                PRIORITY_INTERACTIVE, chat_id, aux.edit_text,
+                                f"**🤖 At first, unban [Assistant ID](https://t.me/{userbot.me.username}) to start stream❗**"
+                            )
+                    except ChatAdminRequired:
+                        return await outbound(
+                            PRIORITY_INTERACTIVE, chat_id, aux.edit_text,
+                            "**🤖 At first, Promote me as an admin❗**"
                         )
-                except ChatAdminRequired:
-                    return await aux.edit_text(
-                        "**🤖 At first, Promote me as an admin❗**"
-                    )
-                except UserNotParticipant:
-                    if message.chat.username:
-                        invitelink = f"https://t.me/{message.chat.username}"
+                    except UserNotParticipant:
+                        if message.chat.username:
+                            invitelink = f"https://t.me/{message.chat.username}"
+                            try:
+                                await userbot.resolve_peer(invitelink)
+                            except Exception:
+                                pass
+                        else:
+                            try:
+                                with trace.span("invite_link"):
+                                    invitelink = await invite_links.get(client, chat_id)
+                            except ChatAdminRequired:
+                                return await outbound(
+                                    PRIORITY_INTERACTIVE, chat_id, aux.edit_text,
+                                    "**🤖 Hey, I need invite user permission to add Assistant ID❗**"
+                                )
+                            except Exception as e:
+                                return await outbound(
+                                    PRIORITY_INTERACTIVE, chat_id, aux.edit_text,
+                                    f"**🚫 Assistant Error:** `{e}`"
+                                )
+                        chat_link = invitelink
                         try:
-                            await app.resolve_peer(invitelink)
-                        except Exception:
+                            await asyncio.sleep(1)
+                            try:
+                                await userbot.join_chat(invitelink)
+                            except (InviteHashExpired, InviteHashInvalid):
+                                # The cached link was revoked, create a new one
+                                invitelink = await invite_links.get(client, chat_id, refresh=True)
+                                chat_link = invitelink
+                                await userbot.join_chat(invitelink)
+                        except InviteRequestSent:
+                            try:
+                                await client.approve_chat_join_request(chat_id, userbot.me.id)
+                            except Exception as e:
+                                return await outbound(
+                                    PRIORITY_INTERACTIVE, chat_id, aux.edit_text,
+                                    f"**🚫 Approve Error:** `{e}`"
+                                )
+                        except UserAlreadyParticipant:
                             pass
-                    else:
-                        try:
-                            invitelink = await client.export_chat_invite_link(chat_id)
-                        except ChatAdminRequired:
-                            return await aux.edit_text(
-                                "**🤖 Hey, I need invite user permission to add Assistant ID❗**"
-                            )
-                        except Exception as e:
-                            return await aux.edit_text(
-                                f"**🚫 Assistant Error:** `{e}`"
-                            )
-                    clinks[chat_id] = invitelink
-                    try:
-                        await asyncio.sleep(1)
-                        await app.join_chat(invitelink)
-                    except InviteRequestSent:
-                        try:
-                            await client.approve_chat_join_request(chat_id, app.me.id)
                         except Exception as e:
-                            return await aux.edit_text(
-                                f"**🚫 Approve Error:** `{e}`"
+                            return await outbound(
+                                PRIORITY_INTERACTIVE, chat_id, aux.edit_text,
+                                f"**🚫 Assistant Join Error:** `{e}`"
                             )
-                    except UserAlreadyParticipant:
-                        pass
-                    except Exception as e:
-                        return await aux.edit_text(
-                            f"**🚫 Assistant Join Error:** `{e}`"
-                        )
                 try:
-                    await call.play(chat_id, media_stream, config=call_config)
+                    with trace.span("call_retry"):
+                        await play_stream(assistant.call, chat_id, media_stream)
                 except NoActiveGroupCall:
-                    return await aux.edit_text(f"**⚠️ No Active VC❗...**")
+                    return await outbound(PRIORITY_INTERACTIVE, chat_id, aux.edit_text, f"**⚠️ No Active VC❗...**")
+                except TelegramServerError:
+                    return await outbound(PRIORITY_INTERACTIVE, chat_id, aux.edit_text, "**⚠️ Telegram Server Issue❗...**")
+                except Exception:
+                    # The retry raises inside the handler, so the outer except never sees it
+                    resolver_cache.invalidate(query, streamtype)
+                    raise
             except TelegramServerError:
-                return await aux.edit_text("**⚠️ Telegram Server Issue❗...**")
-                
-            thumbnail_url = info.get("thumbnail", START_IMAGE_URL)
-            # Download the thumbnail for reliable sending
-            thumbnail_path = await fetch_and_save_image(thumbnail_url, f"cache/temp_{info.get('id', 'thumbnail')}.png")
-            if not thumbnail_path:
-                thumbnail_path = START_IMAGE_URL  # Fallback to START_IMAGE_URL if download fails
+                return await outbound(PRIORITY_INTERACTIVE, chat_id, aux.edit_text, "**⚠️ Telegram Server Issue❗...**")
+            except Exception:
+                # A cached stream_url that fails to play has most likely expired
+                resolver_cache.invalidate(query, streamtype)
+                raise
+            assistants.attach(chat_id, assistant)
+            play_rate.hit()
                 
             pos = await put_queue(
-                chat_id, media_stream, thumbnail_path, title, duration, stream_type, chat_link, mention
+                chat_id, media_stream, START_IMAGE_URL, title, duration, stream_type, chat_link, mention,
+                link=link, seconds=info.get("duration"), stream_url=stream_url,
             )
+            get_queue(chat_id)[pos].started_at = time.time()
+            trace.outcome = "started"
             caption = f"""
 **✅ Started Streaming On VC.**
 
@@ -945,50 +3570,71 @@ Stream Audio Or Video❗...
 **❍ Stream Type:** {stream_type}
 **❍ Requested By:** {mention}"""
         
+        entry = get_queue(chat_id)[pos]
         try:
-            await aux.delete()
+            with trace.span("aux_delete"):
+                await outbound(PRIORITY_INTERACTIVE, chat_id, aux.delete)
         except Exception:
             pass
-        try:
-            # Try sending photo from the path rather than the URL
-            await client.send_photo(chat_id, photo=thumbnail_path, caption=caption, has_spoiler=True, reply_markup=buttons)
-        except Exception as e:
-            # Fall back to a default image if there's an issue with the thumbnail
-            await client.send_photo(chat_id, photo=START_IMAGE_URL, caption=caption, has_spoiler=True, reply_markup=buttons)
-            logs.error(f"Error sending photo: {str(e)}")
+        # Reply right away, the thumbnail is edited in once it is ready
+        thumbnail_path = thumb_task.result() if thumb_task.done() else None
+        with trace.span("reply"):
+            try:
+                reply = await send_cached_photo(client, chat_id, thumbnail_path or START_IMAGE_URL, caption=caption, has_spoiler=True, reply_markup=buttons)
+            except Exception as e:
+                # Fall back to a default image if there's an issue with the thumbnail
+                reply = await send_cached_photo(client, chat_id, START_IMAGE_URL, caption=caption, has_spoiler=True, reply_markup=buttons)
+                logs.error(f"Error sending photo: {str(e)}")
+        play_reply_latency.record(time.perf_counter() - started)
+        trace.add("reply_total", time.perf_counter() - started)
         
-        await add_active_media_chat(chat_id, stream_type)
-        await add_served_chat(chat_id)
-        await log_stream_info(chat_id, title, duration, stream_type, chat_link, mention, thumbnail_path, pos)
+        with trace.span("register"):
+            await add_active_media_chat(chat_id, stream_type)
+            await add_served_chat(chat_id)
+        fire_and_forget(
+            finish_stream_card(
+                reply, thumb_task, entry, caption, buttons, not thumbnail_path,
+                chat_id, title, duration, stream_type, chat_link, mention, pos, trace,
+            )
+        )
+        handed_off = True
     except Exception as e:
+        trace.outcome = "error"
         if "too many open files" in str(e).lower():
             close_all_open_files()
         logs.error(str(e))
-        await aux.edit("**❌ Failed to stream❗...**")
+        await outbound(PRIORITY_INTERACTIVE, chat_id, aux.edit_text, "**❌ Failed to stream❗...**")
+    finally:
+        # Traces that reached the reply are finished by finish_stream_card
+        if not handed_off:
+            play_traces.finish(trace)
 
 
 @bot.on_message(filters.command("pause") & ~filters.private)
 @chat_admins_only
 async def pause_current_stream(client, message):
     chat_id = message.chat.id
-    queued = queues.get(chat_id)
+    queued = get_queue(chat_id)
     if not queued:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**❌ Nothing Streaming.**"
         )
     is_stream = await is_stream_off(chat_id)
     if is_stream:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**✅ Stream already Paused.**"
         )
     try:
-        await call.pause(chat_id)
+        await assistants.call_for(chat_id).pause(chat_id)
     except Exception:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**❌ Failed to pause stream❗**"
         )
     await stream_off(chat_id)
-    return await message.reply_text("**✅ Stream now Paused.**")
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, "**✅ Stream now Paused.**")
     
 
 
@@ -996,51 +3642,159 @@ async def pause_current_stream(client, message):
 @chat_admins_only
 async def resume_current_stream(client, message):
     chat_id = message.chat.id
-    queued = queues.get(chat_id)
+    queued = get_queue(chat_id)
     if not queued:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**❌ Nothing Streaming.**"
         )
     is_stream = await is_stream_off(chat_id)
     if not is_stream:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**✅ Stream already Running.**"
         )
     try:
-        await call.resume(chat_id)
+        await assistants.call_for(chat_id).resume(chat_id)
     except Exception:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**❌ Failed to resume stream❗**"
         )
     await stream_on(chat_id)
-    return await message.reply_text("**✅ Stream now Resumed.**")
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, "**✅ Stream now Resumed.**")
     
 
 @bot.on_message(filters.command("end") & ~filters.private)
 @chat_admins_only
 async def stop_running_stream(client, message):
     chat_id = message.chat.id
-    queued = queues.get(chat_id)
+    queued = get_queue(chat_id)
     if not queued:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**❌ Nothing Streaming.**"
         )
     await close_stream(chat_id)
-    return await message.reply_text("**❎ Streaming Stopped.**")
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, "**❎ Streaming Stopped.**")
 
 
 @bot.on_message(filters.command("skip") & ~filters.private)
 @chat_admins_only
 async def skip_current_stream(client, message):
     chat_id = message.chat.id
-    queued = queues.get(chat_id)
+    queued = get_queue(chat_id)
     if not queued:
-        return await message.reply_text(
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
             "**❌ Nothing streaming❗**"
         )
     return await change_stream(chat_id)
 
 
+@bot.on_message(filters.command("queue") & ~filters.private)
+async def show_stream_queue(client, message):
+    chat_id = message.chat.id
+    queued = get_queue(chat_id)
+    if not queued:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            "**❌ Nothing Streaming.**"
+        )
+    try:
+        page = max(1, int(message.command[1]))
+    except (IndexError, ValueError):
+        page = 1
+    pages = (len(queued) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE
+    page = min(page, pages)
+    lines = []
+    for pos, entry in queued.page(page, QUEUE_PAGE_SIZE):
+        marker = "▶️" if pos == 0 else f"#{pos}"
+        lines.append(f"**{marker}** {entry.title} • `{entry.duration}`")
+    text = "\n".join(lines)
+    return await outbound(
+        PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+        f"**📜 Queue • Page {page}/{pages}**\n\n{text}",
+        disable_web_page_preview=True,
+    )
+
+
+@bot.on_message(filters.command("remove") & ~filters.private)
+@chat_admins_only
+async def remove_queued_stream(client, message):
+    chat_id = message.chat.id
+    queued = get_queue(chat_id)
+    if not queued:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            "**❌ Nothing Streaming.**"
+        )
+    try:
+        entry = queued.remove_at(int(message.command[1]))
+        sessions.mark(chat_id)
+    except (IndexError, ValueError):
+        entry = None
+    if not entry:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            "**❌ Give a valid queue position, e.g. `/remove 2`**"
+        )
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, f"**✅ Removed:** {entry.title}", disable_web_page_preview=True)
+
+
+@bot.on_message(filters.command("move") & ~filters.private)
+@chat_admins_only
+async def move_queued_stream(client, message):
+    chat_id = message.chat.id
+    queued = get_queue(chat_id)
+    if not queued:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            "**❌ Nothing Streaming.**"
+        )
+    try:
+        moved = queued.move(int(message.command[1]), int(message.command[2]))
+        sessions.mark(chat_id)
+    except (IndexError, ValueError):
+        moved = False
+    if not moved:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            "**❌ Give valid queue positions, e.g. `/move 5 1`**"
+        )
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, "**✅ Queue Updated.**")
+
+
+@bot.on_message(filters.command("shuffle") & ~filters.private)
+@chat_admins_only
+async def shuffle_stream_queue(client, message):
+    chat_id = message.chat.id
+    queued = get_queue(chat_id)
+    if not queued or len(queued) < 3:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            "**❌ Not enough tracks to shuffle.**"
+        )
+    queued.shuffle()
+    sessions.mark(chat_id)
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, "**🔀 Queue Shuffled.**")
+
+
+@bot.on_message(filters.command("clear") & ~filters.private)
+@chat_admins_only
+async def clear_stream_queue(client, message):
+    chat_id = message.chat.id
+    queued = get_queue(chat_id)
+    if not queued:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            "**❌ Nothing Streaming.**"
+        )
+    removed = queued.clear_upcoming()
+    sessions.mark(chat_id)
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, f"**✅ Cleared {removed} Queued Tracks.**")
+
+
 @bot.on_callback_query(filters.regex("help_menu"))
 async def open_help_menu_cb(client, query):
     caption = f"""**✅ These are The Commands and
@@ -1052,6 +3806,11 @@ Their Uses.
 /resume - resume paused stream.
 /skip - skip to next stream.
 /end - stop stream & clear queue.
+/queue - show queued streams.
+/remove - remove a queued stream.
+/move - move a queued stream.
+/shuffle - shuffle queued streams.
+/clear - clear queued streams.
 
 Example:
 • /play sidhu moosewala
@@ -1071,7 +3830,14 @@ Example:
         ]
     )
     try:
-        await query.edit_message_caption(caption=caption, reply_markup=buttons)
+        await outbound(
+            PRIORITY_INTERACTIVE,
+            query.message.chat.id,
+            query.edit_message_caption,
+            caption=caption,
+            reply_markup=buttons,
+            edit_of=query.message,
+        )
     except Exception:
         pass
 
@@ -1102,7 +3868,14 @@ powerƒul vc music player bot.
         ]
     )
     try:
-        await query.edit_message_caption(caption=caption, reply_markup=buttons)
+        await outbound(
+            PRIORITY_INTERACTIVE,
+            query.message.chat.id,
+            query.edit_message_caption,
+            caption=caption,
+            reply_markup=buttons,
+            edit_of=query.message,
+        )
     except Exception:
         pass
     
@@ -1110,37 +3883,345 @@ powerƒul vc music player bot.
 @bot.on_message(filters.command("stats") & only_owner)
 async def check_stats(client, message):
     try:
-        await message.delete()
+        await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.delete)
     except Exception:
         pass
-    active_audio = len(active_audio_chats)
-    active_video = len(active_video_chats)
-    total_chats = len(await get_served_chats())
-    total_users = len(await get_served_users())
+    active_audio = len(sessions.audio)
+    active_video = len(sessions.video)
+    total_chats = len(served_chats)
+    total_users = len(served_users)
+    depths = [len(session.queue) for session in sessions.values()]
+    queued_tracks = sum(depths)
+    deepest_queue = max(depths, default=0)
+    cache_stats = resolver_cache.stats()
+    pool_stats = http_pool_stats()
+    flight_stats = resolver_flight.stats()
+    thumb_stats = thumbnail_store.stats()
+    admin_stats = admin_cache.stats()
+    send_stats = outbound_scheduler.stats()
+    worker_load = "".join(
+        f"\n**✅ Call Worker {worker.index}:** pid `{stats['pid']}`, `{len(worker.assistant.chats)}` chats, "
+        f"CPU `{stats['cpu']:.0f}%`, RSS `{stats['rss'] / 1048576:.0f}` MB, `{stats['restarts']}` restarts"
+        for worker in call_workers
+        for stats in [worker.stats()]
+    )
+    assistant_load = ", ".join(
+        f"{item['name']} {item['chats']}{'' if item['healthy'] else ' ❌'}"
+        for item in assistants.stats()
+    )
+    send_delays = " / ".join(
+        f"{name} {delay:.2f}s" for name, delay in send_stats["delays"].items()
+    )
+    chat_session = sessions.get(message.chat.id)
+    chat_gaps = chat_session.gaps if chat_session and chat_session.gaps.count else None
+    chat_gap = (
+        f"\n**✅ This Chat Gap p50/p95:** `{chat_gaps.percentile(50):.2f}s / {chat_gaps.percentile(95):.2f}s`"
+        if chat_gaps else ""
+    )
+    direct, search = resolver_paths["direct"], resolver_paths["search"]
     
     caption = f"""
 **✅ Active Audio Chats:** `{active_audio}`
 **✅ Active Video Chats:** `{active_video}`
+**✅ Assistants:** `{assistant_load}` (`{assistants.failovers}` failovers){worker_load}
+**✅ Queued Tracks:** `{queued_tracks}` (deepest `{deepest_queue}`)
+**✅ Plays Per Minute:** `{play_rate.rate()}`
+**✅ /play Reply p50/p95:** `{play_reply_latency.percentile(50):.2f}s / {play_reply_latency.percentile(95):.2f}s`
 
 **✅ Total Served Chats:** `{total_chats}`
 **✅ Total Served Users:** `{total_users}`
+**✅ Last Restore:** `{restore_stats['restored']}/{restore_stats['chats']}` chats in `{restore_stats['seconds']:.1f}s`
+**✅ Log Events:** `{log_stats['sent']}` sent, `{log_stats['merged']}` merged, `{log_stats['dropped']}` dropped, `{len(log_events)}` waiting
+**✅ Outbound Queue:** `{send_stats['queued']}` queued, `{send_stats['flood_waits']}` FloodWaits, `{send_stats['coalesced']}` edits merged
+**✅ Outbound Delay p95:** `{send_delays}`
+**✅ Pending DB Writes:** `{len(served_chats.pending) + len(served_users.pending)}`
+
+**✅ Resolver p50/p95/p99:** `{resolve_latency.percentile(50):.2f}s / {resolve_latency.percentile(95):.2f}s / {resolve_latency.percentile(99):.2f}s`
+**✅ Resolver Cache:** `{cache_stats['size']}` entries
+**✅ Cache Hits/Misses:** `{cache_stats['hits']}/{cache_stats['misses']}`
+**✅ Coalesced Resolutions:** `{flight_stats['coalesced']}` (`{flight_stats['coalesce_ratio']:.0%}`)
+**✅ Direct Path:** `{direct['wins']}/{direct['started']}` wins, p95 `{direct['latency'].percentile(95):.2f}s`
+**✅ Search Path:** `{search['wins']}/{search['started']}` wins, p95 `{search['latency'].percentile(95):.2f}s`
+**✅ Track Gap p50/p95:** `{transition_gaps.percentile(50):.2f}s / {transition_gaps.percentile(95):.2f}s`{chat_gap}
+**✅ Queue Refresh Hits/Misses:** `{lookahead_stats['hits']}/{lookahead_stats['misses']}` (`{lookahead_stats['refreshed']}` re-resolved)
+**✅ Thumbnail Cache:** `{thumb_stats['files']}` files, `{thumb_stats['bytes'] / 1048576:.1f}` MB, `{thumb_stats['hit_rate']:.0%}` hits
+**✅ Downloads:** `{sum(host['requests'] for host in download_stats.values())}` (`{sum(host['bytes'] for host in download_stats.values()) / 1048576:.1f}` MB)
+**✅ Admin Cache:** `{admin_stats['entries']}` entries, `{admin_stats['hit_rate']:.0%}` hits, `{admin_stats['warmups']}` warm-ups
+**✅ Photo ID Cache:** `{len(photo_ids.file_ids)}` ids, `{photo_ids.hits}/{photo_ids.misses}` hits/misses
+**✅ HTTP Pool:** `{pool_stats['connections']}/{pool_stats['max_connections']}` conns, `{pool_stats['idle']}` idle
+**✅ HTTP In-Flight:** `{pool_stats['inflight']}` (peak `{pool_stats['peak_inflight']}`)
 """
-    return await message.reply_text(caption)
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, caption)
+
+
+@bot.on_message(filters.command("perf") & only_owner)
+async def check_perf(client, message):
+    try:
+        await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.delete)
+    except Exception:
+        pass
+    try:
+        minutes = float(message.command[1])
+    except (IndexError, ValueError):
+        minutes = PERF_WINDOW_MINUTES
+    traces = play_traces.recent(minutes)
+    if not traces:
+        return await outbound(
+            PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
+            f"**❌ No /play traces in the last {minutes:g} minutes.**"
+        )
+    rows = [f"{'stage':<16}{'p50':>7}{'p95':>7}{'p99':>7}{'n':>5}"]
+    for stage, stats in play_traces.stage_stats(traces).items():
+        rows.append(
+            f"{stage:<16}{stats.percentile(50):>7.2f}{stats.percentile(95):>7.2f}"
+            f"{stats.percentile(99):>7.2f}{stats.count:>5}"
+        )
+    slowest = []
+    for trace in play_traces.slowest(traces, PERF_SLOWEST):
+        spans = " → ".join(f"{stage} {seconds:.2f}s" for stage, seconds in trace.spans)
+        age = (time.time() - trace.finished_at) / 60
+        slowest.append(
+            f"**❍ {trace.total:.2f}s** • {trace.outcome} • `{trace.chat_id}` • {age:.0f} min ago\n"
+            f"    `{(trace.query or '')[:40]}`\n    {spans}"
+        )
+    rows = "\n".join(rows)
+    slowest = "\n".join(slowest)
+    caption = f"""
+**⏱ /play Stages, last {minutes:g} min ({len(traces)} traces)**
+```
+{rows}
+```
+**🐢 Slowest Traces**
+{slowest}"""
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, caption)
+
+
+
+# Broadcast Engine
+
+broadcastsdb = mongodb.broadcasts
+broadcast_tasks = set()
+broadcast_pause_until = 0.0
+
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+
+async def wait_broadcast_pause():
+    while True:
+        delay = broadcast_pause_until - time.monotonic()
+        if delay <= 0:
+            return
+        await asyncio.sleep(delay)
+
+
+class BroadcastJob:
+    targets = {
+        "chats": (chatsdb, "chat_id", {"$lt": 0}),
+        "users": (usersdb, "user_id", {"$gt": 0}),
+    }
+
+    def __init__(self, job):
+        self.job = job
+        self.sent = job.get("sent", 0)
+        self.failed = job.get("failed", 0)
+        self.pins = job.get("pins", 0)
+        self.flood_waits = 0
+        self.started = time.monotonic()
+        self.sent_at_start = self.sent
+        self.status_message = None
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.started
+        return (self.sent - self.sent_at_start) / elapsed if elapsed > 0 else 0.0
+
+    def progress_text(self, done=False):
+        kind = self.job["kind"]
+        if done and kind == "chats":
+            return f"**✅ Global Broadcast Done.**\n\n__🤖 Broadcast Mesaages In\n{self.sent} Chats With {self.pins} Pins.__"
+        if done:
+            return f"**✅ Global Broadcast Done.**\n\n__🤖 Broascast Mesaages To\n{self.sent} Users From Bot.__"
+        return f"""**📣 Broadcasting To {kind.title()}...**
+
+**❍ Sent:** `{self.sent}`
+**❍ Failed:** `{self.failed}`
+**❍ Pins:** `{self.pins}`
+**❍ FloodWaits:** `{self.flood_waits}`
+**❍ Speed:** `{self.throughput():.1f}` msg/s"""
+
+    async def iter_batches(self):
+        collection, field, condition = self.targets[self.job["kind"]]
+        condition = dict(condition)
+        if self.job.get("last_id") is not None:
+            condition["$gt"] = self.job["last_id"]
+        cursor = collection.find(
+            {field: condition}, {field: 1, "_id": 0}
+        ).sort(field, 1)
+        batch = []
+        async for doc in cursor:
+            batch.append(int(doc[field]))
+            if len(batch) >= BROADCAST_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def send_one(self, semaphore, target):
+        global broadcast_pause_until
+        async with semaphore:
+            for _ in range(BROADCAST_MAX_RETRIES):
+                await wait_broadcast_pause()
+                await broadcast_bucket.acquire()
+                try:
+                    if self.job.get("message_id"):
+                        m = await outbound(
+                            PRIORITY_BROADCAST,
+                            target,
+                            bot.forward_messages,
+                            target,
+                            self.job["from_chat_id"],
+                            self.job["message_id"],
+                        )
+                    else:
+                        m = await outbound(
+                            PRIORITY_BROADCAST, target, bot.send_message, target, text=self.job["text"]
+                        )
+                except FloodWait as e:
+                    # Pause every worker, then retry this target
+                    self.flood_waits += 1
+                    broadcast_pause_until = max(
+                        broadcast_pause_until, time.monotonic() + e.value + 1
+                    )
+                    continue
+                except Exception:
+                    break
+                self.sent += 1
+                if self.job.get("pin"):
+                    try:
+                        await outbound(
+                            PRIORITY_BROADCAST,
+                            target,
+                            m.pin,
+                            disable_notification=self.job["pin"] != "loud",
+                        )
+                        self.pins += 1
+                    except Exception:
+                        pass
+                return
+            self.failed += 1
+
+    async def report_progress(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                await outbound(
+                    PRIORITY_BROADCAST,
+                    self.status_message.chat.id,
+                    self.status_message.edit_text,
+                    self.progress_text(),
+                    edit_of=self.status_message,
+                )
+            except Exception:
+                pass
+
+    async def run(self):
+        if self.job["kind"] == "chats":
+            await served_chats.flush()
+        else:
+            await served_users.flush()
+        try:
+            self.status_message = await outbound(
+                PRIORITY_INTERACTIVE,
+                self.job["report_chat_id"],
+                bot.send_message,
+                self.job["report_chat_id"],
+                self.progress_text(),
+            )
+        except Exception:
+            self.status_message = None
+        reporter = (
+            asyncio.create_task(self.report_progress())
+            if self.status_message else None
+        )
+        semaphore = asyncio.Semaphore(BROADCAST_WORKERS)
+        try:
+            async for batch in self.iter_batches():
+                await asyncio.gather(
+                    *(self.send_one(semaphore, target) for target in batch)
+                )
+                # Checkpoint after each batch so a restart resumes from here
+                self.job["last_id"] = batch[-1]
+                await timed_mongo("broadcast_checkpoint", broadcastsdb.update_one(
+                    {"_id": self.job["_id"]},
+                    {"$set": {
+                        "last_id": batch[-1],
+                        "sent": self.sent,
+                        "failed": self.failed,
+                        "pins": self.pins,
+                    }},
+                ))
+        finally:
+            if reporter:
+                reporter.cancel()
+        await broadcastsdb.update_one(
+            {"_id": self.job["_id"]}, {"$set": {"status": "done"}}
+        )
+        try:
+            if self.status_message:
+                await outbound(
+                    PRIORITY_INTERACTIVE,
+                    self.status_message.chat.id,
+                    self.status_message.edit_text,
+                    self.progress_text(done=True),
+                    edit_of=self.status_message,
+                )
+            else:
+                await outbound(
+                    PRIORITY_INTERACTIVE,
+                    self.job["report_chat_id"],
+                    bot.send_message,
+                    self.job["report_chat_id"],
+                    self.progress_text(done=True),
+                )
+        except Exception:
+            pass
+
+
+async def run_broadcast_jobs(jobs):
+    for job in jobs:
+        try:
+            await BroadcastJob(job).run()
+        except Exception as e:
+            logs.error(f"Broadcast {job['_id']} stopped: {e}")
 
 
+def start_broadcast_jobs(jobs):
+    task = asyncio.create_task(run_broadcast_jobs(jobs))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+    return task
+
+
+async def resume_broadcasts():
+    jobs = []
+    async for job in broadcastsdb.find({"status": "running"}).sort("created_at", 1):
+        jobs.append(job)
+    if jobs:
+        logs.info(f"🔁 Resuming {len(jobs)} unfinished broadcast job(s)")
+        start_broadcast_jobs(jobs)
+
 
 @bot.on_message(filters.command(["broadcast", "gcast"]) & only_owner)
 async def broadcast_message(client, message):
     try:
-        await message.delete()
+        await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.delete)
     except:
         pass
-    if message.reply_to_message:
-        x = message.reply_to_message.id
-        y = message.chat.id
-    else:
+    query = None
+    if not message.reply_to_message:
         if len(message.command) < 2:
-            return await message.reply_text(
+            return await outbound(
+                PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
                 f"""**🤖 Hey Give Me Some Text
 Or Reply To A Message❗**"""
             )
@@ -1154,70 +4235,45 @@ Or Reply To A Message❗**"""
         if "-user" in query:
             query = query.replace("-user", "")
         if query == "":
-            return await message.reply_text(
+            return await outbound(
+                PRIORITY_INTERACTIVE, message.chat.id, message.reply_text,
                 f"""**🤖 Hey Give Me Some Text
 Or Reply To A Message❗**"""
             )
 
-    
-    # Bot broadcast inside chats
+    if "-pinloud" in message.text:
+        pin = "loud"
+    elif "-pin" in message.text:
+        pin = "silent"
+    else:
+        pin = None
+    kinds = []
     if "-nobot" not in message.text:
-        sent = 0
-        pin = 0
-        chats = []
-        schats = await get_served_chats()
-        for chat in schats:
-            chats.append(int(chat["chat_id"]))
-        for i in chats:
-            try:
-                m = (
-                    await bot.forward_messages(i, y, x)
-                    if message.reply_to_message
-                    else await bot.send_message(i, text=query)
-                )
-                if "-pin" in message.text:
-                    try:
-                        await m.pin(disable_notification=True)
-                        pin += 1
-                    except Exception:
-                        continue
-                elif "-pinloud" in message.text:
-                    try:
-                        await m.pin(disable_notification=False)
-                        pin += 1
-                    except Exception:
-                        continue
-                sent += 1
-            except FloodWait as e:
-                await asyncio.sleep(e.value)
-                continue
-            except Exception:
-                continue
-        await message.reply_text(f"**✅ Global Broadcast Done.**\n\n__🤖 Broadcast Mesaages In\n{sent} Chats With {pin} Pins.__")
-
-    
-
-    # Bot broadcasting to users
+        kinds.append("chats")
     if "-user" in message.text:
-        susr = 0
-        served_users = []
-        susers = await get_served_users()
-        for user in susers:
-            served_users.append(int(user["user_id"]))
-        for i in served_users:
-            try:
-                m = (
-                    await bot.forward_messages(i, y, x)
-                    if message.reply_to_message
-                    else await bot.send_message(i, text=query)
-                )
-                susr += 1
-            except FloodWait as e:
-                await asyncio.sleep(e.value)
-                continue
-            except Exception:
-                continue
-        await message.reply_text(f"**✅ Global Broadcast Done.**\n\n__🤖 Broascast Mesaages To\n{susr} Users From Bot.__")
+        kinds.append("users")
+    
+    jobs = []
+    for kind in kinds:
+        job = {
+            "_id": f"{int(time.time() * 1000)}-{kind}",
+            "kind": kind,
+            "status": "running",
+            "created_at": time.time(),
+            "report_chat_id": message.chat.id,
+            "from_chat_id": message.chat.id if message.reply_to_message else None,
+            "message_id": message.reply_to_message.id if message.reply_to_message else None,
+            "text": query,
+            "pin": pin if kind == "chats" else None,
+            "last_id": None,
+            "sent": 0,
+            "failed": 0,
+            "pins": 0,
+        }
+        await broadcastsdb.insert_one(job)
+        jobs.append(job)
+    if jobs:
+        start_broadcast_jobs(jobs)
 
 
 
@@ -1254,13 +4310,18 @@ with your other ƒriends.**"""
     sent = 0
     for chat_id in total_chats:
         try:
-            m = await client.send_photo(
-                chat_id, photo=photo, caption=caption, reply_markup=buttons
+            m = await send_cached_photo(
+                client,
+                chat_id,
+                photo,
+                priority=PRIORITY_BROADCAST,
+                caption=caption,
+                reply_markup=buttons,
             )
             sent = sent + 1
             await asyncio.sleep(5)
             try:
-                await m.pin(disable_notification=False)
+                await outbound(PRIORITY_BROADCAST, chat_id, m.pin, disable_notification=False)
             except Exception:
                 continue
         except FloodWait as e:
@@ -1268,7 +4329,7 @@ with your other ƒriends.**"""
             continue
         except Exception:
             continue
-    return await message.reply_text(f"**✅ Successfully posted in {sent} chats.**")
+    return await outbound(PRIORITY_INTERACTIVE, message.chat.id, message.reply_text, f"**✅ Successfully posted in {sent} chats.**")
 
 
 
@@ -1279,12 +4340,26 @@ with your other ƒriends.**"""
 @bot.on_callback_query(filters.regex("force_close"))
 async def force_close_anything(client, query):
     try:
-        await query.message.delete()
+        await outbound(PRIORITY_INTERACTIVE, query.message.chat.id, query.message.delete)
     except Exception:
         pass
 
 
 
+@bot.on_chat_member_updated()
+async def refresh_admin_cache(client, update):
+    # Ordinary joins and leaves cannot change who may control the stream
+    admins = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+    members = [
+        member for member in (update.old_chat_member, update.new_chat_member)
+        if member
+    ]
+    if not any(member.status in admins for member in members):
+        return
+    user = members[-1].user
+    admin_cache.invalidate(update.chat.id, user.id if user else None)
+
+
 @bot.on_message(filters.new_chat_members, group=-1)
 async def add_chat_id(client, message):
     chat_id = message.chat.id
@@ -1304,8 +4379,19 @@ async def stream_services_handler(_, update: Update):
     
 @call.on_update(fl.stream_end())
 async def stream_end_handler(_, update: Update):
+    ended_at = time.perf_counter()
     chat_id = update.chat_id
-    return await change_stream(chat_id)
+    return await change_stream(chat_id, ended_at)
+
+
+for extra in assistants.assistants[1:]:
+    for status in (
+        ChatUpdate.Status.CLOSED_VOICE_CHAT,
+        ChatUpdate.Status.KICKED,
+        ChatUpdate.Status.LEFT_GROUP,
+    ):
+        extra.call.on_update(fl.chat_update(status))(stream_services_handler)
+    extra.call.on_update(fl.stream_end())(stream_end_handler)
 
 
 